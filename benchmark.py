@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+# Offline latency benchmark for the go-live pipeline.
+#
+# Runs a local stand-in for the Twitch API and a fake Discord client, then
+# fires signed stream notifications through either the CGI script and the
+# POSIX MQ (--path cgi) or the in-process receiver (--path receiver), on into
+# bottington.mq_handler_task and twitch.parse_streams. Reports p50/p95/p99
+# callback-to-announcement latency and throughput, plus microbenchmarks of
+# on_message dispatch and notification dedup.
+
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import random
+import shutil
+import hashlib
+import argparse
+import datetime
+import tempfile
+import collections
+import asyncio
+import aiohttp
+from aiohttp import web
+
+SECRET = 'benchmark-secret'
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def report(name, samples, elapsed = None):
+    if not samples:
+        print('%-28s no samples' % name)
+        return
+    line = '%-28s n=%-6d p50=%9.3fms p95=%9.3fms p99=%9.3fms' % (
+        name, len(samples),
+        percentile(samples, 50) * 1000, percentile(samples, 95) * 1000, percentile(samples, 99) * 1000)
+    if elapsed:
+        line += ' %8.1f/s' % (len(samples) / elapsed)
+    print(line)
+
+class FakeHelix:
+    """Just enough of helix/users and helix/games for parse_streams."""
+    def __init__(self, loop, delay):
+        self.loop = loop
+        self.delay = delay
+        self.requests = 0
+        self.app = web.Application(loop = loop)
+        self.app.router.add_route('GET', '/helix/users', self.users)
+        self.app.router.add_route('GET', '/helix/games', self.games)
+        self.handler = None
+        self.server = None
+
+    async def start(self):
+        self.handler = self.app.make_handler()
+        self.server = await self.loop.create_server(self.handler, '127.0.0.1', 0)
+        return 'http://127.0.0.1:%d/' % self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def respond(self, data):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(text = json.dumps({ 'data': data }), content_type = 'application/json')
+
+    async def users(self, request):
+        return await self.respond([{ 'id':                user_id,
+                                     'login':             'bench%s' % user_id,
+                                     'display_name':      'Bench%s' % user_id,
+                                     'profile_image_url': 'https://example.com/%s.png' % user_id }
+                                   for user_id in request.query.getall('id', [])])
+
+    async def games(self, request):
+        return await self.respond([{ 'id': game_id, 'name': 'Game %s' % game_id }
+                                   for game_id in request.query.getall('id', [])])
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.mention = '<@%s>' % user_id
+
+class FakeChannel:
+    def __init__(self, channel_id, name, server):
+        self.id = channel_id
+        self.name = name
+        self.server = server
+        self.is_private = False
+
+class FakeServer:
+    def __init__(self, server_id, channel_names):
+        self.id = server_id
+        self.name = 'Benchmark'
+        self.channels = [FakeChannel(str(1000 + i), name, self) for (i, name) in enumerate(channel_names)]
+
+class FakeMessage:
+    def __init__(self, message_id, channel, content = None, author = None, embed = None):
+        self.id = message_id
+        self.channel = channel
+        self.server = channel.server
+        self.content = content
+        self.author = author
+        self.embed = embed
+
+class FakeClient:
+    """Stands in for discord.Client, answering after an optional simulated delay."""
+    def __init__(self, loop, server, delay, on_send):
+        self.loop = loop
+        self.user = FakeUser('1', 'Bottington')
+        self.is_closed = False
+        self.delay = delay
+        self.on_send = on_send
+        self.channels = dict((channel.id, channel) for channel in server.channels)
+        self.next_id = 0
+        self.calls = collections.Counter()
+        self.in_flight = 0
+
+    async def api_call(self, name):
+        self.calls[name] += 1
+        if self.delay:
+            self.in_flight += 1
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self.in_flight -= 1
+
+    async def idle(self):
+        # Let trailing deletes finish before the handler is torn down
+        while self.in_flight:
+            await asyncio.sleep(0.01)
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def send_message(self, channel, content = None, embed = None):
+        await self.api_call('send_message')
+        self.next_id += 1
+        message = FakeMessage(str(self.next_id), channel, content, self.user, embed)
+        self.on_send(message)
+        return message
+
+    async def edit_message(self, message, new_content = None, embed = None):
+        await self.api_call('edit_message')
+        edited = FakeMessage(message.id, message.channel, new_content, self.user, embed)
+        self.on_send(edited)
+        return edited
+
+    async def delete_message(self, message):
+        await self.api_call('delete_message')
+
+    async def add_reaction(self, message, emoji):
+        await self.api_call('add_reaction')
+
+    async def change_presence(self, game = None):
+        await self.api_call('change_presence')
+
+def make_notification(user_id, game_id):
+    started_at = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    return { 'data': [{ 'id':           str(random.randint(1, 10 ** 10)),
+                        'user_id':      user_id,
+                        'user_name':    'Bench%s' % user_id,
+                        'game_id':      game_id,
+                        'community_ids': [],
+                        'type':         'live',
+                        'title':        'Benchmarking, what-ho!',
+                        'viewer_count': 0,
+                        'started_at':   started_at,
+                        'language':     'en',
+                        'thumbnail_url': '' }] }
+
+def sign(body):
+    return 'sha256=%s' % hmac.new(SECRET.encode('utf-8'), msg=body.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
+
+class Pipeline:
+    def __init__(self, args, loop, workdir, bottington, server):
+        self.args = args
+        self.loop = loop
+        self.workdir = workdir
+        self.bottington = bottington
+        self.server = server
+        self.sent_at = collections.defaultdict(collections.deque)
+        self.latencies = []
+        # Announcements to wait for
+        self.expected = args.notifications
+        self.done = asyncio.Event()
+        self.http = None
+
+    def on_send(self, message):
+        if message.embed is None:
+            return
+        login = message.embed.url.rsplit('/', 1)[1]
+        # Notifications coalesced into this announcement are all answered by it
+        now = time.perf_counter()
+        while self.sent_at[login]:
+            self.latencies.append(now - self.sent_at[login].popleft())
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+    async def send_cgi(self, query, body, notification_id):
+        env = dict(os.environ,
+                   REQUEST_URI = '/benchmark',
+                   REQUEST_METHOD = 'POST',
+                   QUERY_STRING = query,
+                   HTTP_X_HUB_SIGNATURE = sign(body),
+                   HTTP_TWITCH_NOTIFICATION_ID = notification_id,
+                   BOTTINGTON_TWITCH_SECRET = SECRET,
+                   BOTTINGTON_LOG_DIR = self.workdir)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twitch_webhook.py')
+        proc = await asyncio.create_subprocess_exec(sys.executable, script,
+                                                    stdin = asyncio.subprocess.PIPE,
+                                                    stdout = asyncio.subprocess.DEVNULL,
+                                                    env = env)
+        await proc.communicate(body.encode('utf-8'))
+
+    async def send_receiver(self, query, body, notification_id):
+        headers = { 'X-Hub-Signature':         sign(body),
+                    'Twitch-Notification-Id':  notification_id,
+                    'Content-Type':            'application/json' }
+        receiver = self.bottington.webhook_receiver
+        url = 'http://%s:%s%s?%s' % (receiver.host, receiver.port, receiver.path, query)
+        async with self.http.post(url, data = body, headers = headers) as r:
+            await r.read()
+
+    async def run(self):
+        args = self.args
+        send = self.send_cgi if args.path == 'cgi' else self.send_receiver
+        self.http = aiohttp.ClientSession(loop = self.loop)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def fire(i):
+            user_id = str(100000 + (i % args.users))
+            game_id = str(500 + (i % args.games))
+            body = json.dumps(make_notification(user_id, game_id))
+            query = 'lb3.server=%s&lb3.user_id=%s' % (self.server.id, user_id)
+            async with semaphore:
+                self.sent_at['bench%s' % user_id].append(time.perf_counter())
+                await send(query, body, str(uuid.uuid4()))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[fire(i) for i in range(args.notifications)])
+        try:
+            await asyncio.wait_for(self.done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print('Timed out with %d of %d announcements' % (len(self.latencies), self.expected))
+        elapsed = time.perf_counter() - start
+        await self.http.close()
+        report('pipeline (%s)' % args.path, self.latencies, elapsed)
+
+async def bench_on_message(bottington, server, iterations):
+    general = server.channels[0]
+    config_channel = server.channels[1]
+    author = FakeUser('2', 'Bertie')
+    cases = [ ('on_message no mention',  FakeMessage('m', general, 'Just chatting about nothing much', author)),
+              ('on_message greeting',    FakeMessage('m', general, '<@1> hello there', author)),
+              ('on_message command',     FakeMessage('m', config_channel, '<@1> status benchmarking', author)) ]
+    for (name, message) in cases:
+        samples = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            await bottington.on_message(message)
+            samples.append(time.perf_counter() - start)
+        report(name, samples)
+
+def bench_dedup(webhook, server_id, iterations):
+    samples = []
+    for i in range(iterations):
+        notification_id = str(uuid.uuid4())
+        start = time.perf_counter()
+        webhook.is_id_duplicate(server_id, notification_id)
+        samples.append(time.perf_counter() - start)
+    report('is_id_duplicate new', samples)
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        webhook.is_id_duplicate(server_id, notification_id)
+        samples.append(time.perf_counter() - start)
+    report('is_id_duplicate repeat', samples)
+
+def bench_mqformat(iterations):
+    """Encode/decode cost of an MQ message, checking it comes back exactly as
+    sent, null stream fields and all, whole and chunked."""
+    import mqformat
+    message = { 'action':   'stream',
+                'args':     { 'lb3.server': ['1'], 'lb3.user_id': ['1'] },
+                'data':     [{ 'user_id': '1', 'game_id': None, 'type': 'live', 'title': None,
+                                 'started_at': '2020-01-01T00:00:00Z' }],
+                'received': time.time() }
+    for max_size in (1024, 64):
+        decoder = mqformat.Decoder()
+        samples = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            for frame in mqformat.encode(message, max_size):
+                decoded = decoder.feed(frame)
+            samples.append(time.perf_counter() - start)
+            if decoded != message:
+                raise AssertionError('MQ round trip changed the message: %r' % decoded)
+        report('mqformat round trip %d' % max_size, samples)
+
+class Harness:
+    """The bot wired to the local stand-ins, ready for pipeline_class to drive.
+    args needs path, helix_delay and discord_delay."""
+    def __init__(self, args, pipeline_class):
+        self.workdir = tempfile.mkdtemp(prefix = 'lb3-bench-')
+        self.server = FakeServer(str(random.randint(10 ** 17, 10 ** 18)), ['general', 'config', 'streams'])
+        config = { 'log-file': os.path.join(self.workdir, 'bottington.log'),
+                   'twitch': { 'secret':      SECRET,
+                               'client-id':   'benchmark',
+                               'app-token':   'benchmark',
+                               'webhook_uri': 'http://127.0.0.1/' },
+                   'discord': { 'server':          self.server.id,
+                                'token':           'benchmark',
+                                'greeting':        'What-ho',
+                                'config_channels': ['config'],
+                                'channels':        { '_default_': 'streams' } },
+                   'webhook-receiver': { 'host': '127.0.0.1', 'port': 0, 'path': '/benchmark' },
+                   # Replayed notifications started long ago
+                   'event-queue': { 'max-age': 0 } }
+        config_file = os.path.join(self.workdir, 'lb3-conf.json')
+        with open(config_file, 'w') as outfile:
+            json.dump(config, outfile)
+
+        self.loop = loop = asyncio.get_event_loop()
+        self.helix = FakeHelix(loop, args.helix_delay)
+        config['twitch']['api-uri'] = loop.run_until_complete(self.helix.start())
+
+        # bottington reads its config from argv on import
+        sys.argv = [sys.argv[0], config_file]
+        import bottington
+        import webclient
+        import webhook
+        import receiver
+        import mqreader
+        import router
+        import guilds
+        import eventqueue
+        webhook.log_dir = self.workdir
+        bottington.config = config
+        self.bottington = bottington
+
+        self.pipeline = pipeline_class(args, loop, self.workdir, bottington, self.server)
+        self.client = FakeClient(loop, self.server, args.discord_delay, self.pipeline.on_send)
+        bottington.client = self.client
+        guild = guilds.Guild(self.server, guilds.guild_configs(config)[self.server.id])
+        bottington.guild_index[self.server.id] = guild
+        bottington.command_router = router.CommandRouter(self.client.user.id)
+        bottington.command_router.add_commands(vars(bottington))
+        bottington.event_queue = eventqueue.EventQueue.from_config(config)
+        webclient.open_session(config, loop)
+
+        self.queue_name = '/bottington_%s' % self.server.id
+        self.mq_reader = mqreader.MqReader(self.queue_name, bottington.enqueue_messages, loop)
+        self.mq_reader.start()
+        guild.mq_reader = self.mq_reader
+        if args.path == 'receiver':
+            webhook_receiver = receiver.WebhookReceiver(config, [self.server.id], lambda message: bottington.enqueue_messages([message]), loop)
+            loop.run_until_complete(webhook_receiver.start())
+            webhook_receiver.port = webhook_receiver.server.sockets[0].getsockname()[1]
+            bottington.webhook_receiver = webhook_receiver
+        self.handler_task = loop.create_task(bottington.mq_handler_task())
+
+    def settle(self):
+        """Wait for queued Discord calls to finish."""
+        import outbox
+        self.loop.run_until_complete(outbox.actions.join())
+        self.loop.run_until_complete(self.client.idle())
+
+    def close(self):
+        import outbox
+        import webclient
+        loop = self.loop
+        self.client.is_closed = True
+        self.handler_task.cancel()
+        loop.run_until_complete(outbox.actions.stop())
+        self.mq_reader.stop()
+        self.mq_reader.mq_queue.unlink()
+        if self.bottington.webhook_receiver:
+            loop.run_until_complete(self.bottington.webhook_receiver.stop())
+        loop.run_until_complete(webclient.close_session())
+        loop.run_until_complete(self.helix.stop())
+        shutil.rmtree(self.workdir, ignore_errors = True)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Offline latency benchmark for Lord Bottington')
+    parser.add_argument('--path', choices = ['cgi', 'receiver'], default = 'receiver',
+                        help = 'callback path to drive')
+    parser.add_argument('--notifications', type = int, default = 200)
+    parser.add_argument('--concurrency', type = int, default = 8,
+                        help = 'callbacks in flight at once')
+    parser.add_argument('--users', type = int, default = 50, help = 'distinct streamers')
+    parser.add_argument('--games', type = int, default = 10, help = 'distinct games')
+    parser.add_argument('--helix-delay', type = float, default = 0.05, help = 'simulated Twitch API latency (s)')
+    parser.add_argument('--discord-delay', type = float, default = 0.1, help = 'simulated Discord API latency (s)')
+    parser.add_argument('--iterations', type = int, default = 10000, help = 'microbenchmark iterations')
+    parser.add_argument('--timeout', type = float, default = 120)
+    parser.add_argument('--metrics', action = 'store_true', help = 'dump the per-stage metrics after the pipeline run')
+    args = parser.parse_args()
+
+    harness = Harness(args, Pipeline)
+    loop = harness.loop
+    try:
+        loop.run_until_complete(harness.pipeline.run())
+        harness.settle()
+        if args.metrics:
+            import metrics
+            print(metrics.render())
+        print('Twitch API requests: %d  Discord calls: %s' % (harness.helix.requests, dict(harness.client.calls)))
+        # Dispatch cost only, without the simulated Discord round trips
+        harness.client.delay = 0
+        loop.run_until_complete(bench_on_message(harness.bottington, harness.server, args.iterations))
+        import webhook
+        bench_dedup(webhook, harness.server.id, min(args.iterations, 2000))
+        bench_mqformat(min(args.iterations, 2000))
+    finally:
+        harness.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,6 @@
 #!/usr/bin/python3
 
 import discord
-import ipcqueue.posixmq
-import threading
 import asyncio
 import json
 import socket
@@ -11,11 +9,26 @@ import os
 import sys
 import datetime
 import time
-import re
+import signal
 
 import twitch
 import trello
 import streamers
+import webclient
+import receiver
+import webhook
+import mqreader
+import router
+import streamstate
+import metrics
+import guilds
+import leases
+import outbox
+import logsetup
+import control
+import subscriptions
+import eventqueue
+import profiler
 
 # Read config
 config_file = sys.argv[1] if len(sys.argv) > 1 else 'lb3-conf.json'
@@ -23,65 +36,121 @@ print("What-ho! Bottington here")
 print("Getting my papers from '%s'" % config_file)
 with open(config_file, 'r') as infile:
     config = json.load(infile)
+config_mtime = os.stat(config_file).st_mtime
 
 FORMAT = '%(asctime)-15s %(levelname)-5s %(name)s %(message)s'
+# Handlers run on a QueueListener thread, so writing the log never holds up the event loop
+log_json = (config.get('log-format') == 'json')
+log_max_length = config.get('log-max-length', logsetup.DEFAULT_MAX_LENGTH)
 if 'log-file' in config:
     print("Logging to %s" % config['log-file'])
     log_handler = logging.handlers.WatchedFileHandler(config['log-file'])
-    formatter = logging.Formatter(FORMAT)
-    formatter.converter = time.gmtime  # if you want UTC time
-    log_handler.setFormatter(formatter)
-    logger = logging.getLogger('bottington')
-    logger.addHandler(log_handler)
-    logger.setLevel(logging.INFO)
+    # UTC timestamps. On the root logger so every module's lines are written,
+    # but discord.py's connection chatter and aiohttp's per-request access
+    # lines (every callback and metrics scrape) only when something's wrong
+    logsetup.start_logging(log_handler, logging.INFO, None, FORMAT, utc = True,
+                           json_format = log_json, max_length = log_max_length)
+    for noisy_logger in ('discord', 'aiohttp.access'):
+        logging.getLogger(noisy_logger).setLevel(logging.WARNING)
 else:
-    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
-    logger = logging.getLogger('bottington')
+    logsetup.start_logging(logging.StreamHandler(), logging.DEBUG, None, FORMAT,
+                           json_format = log_json, max_length = log_max_length)
+logger = logging.getLogger('bottington')
 logger.info("\n\nBottington started at %s\n", datetime.datetime.now())
 
 client = discord.Client()
-server = None
-config_channels = []
-chat_channel_in = None
-chat_channel_out = None
-commands = {}
+# guilds.Guild for each server we serve, by server ID
+guild_index = {}
+command_router = None
+webhook_receiver = None
+control_server = None
+event_queue = None
+metrics_server = None
+lease_scheduler = None
 
 async def default_check_message(client, message):
     return False
 check_message = default_check_message
 
-class MqReceiveThread (threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        queue_name = '/bottington_%s' % server.id
-        self.mq_queue = ipcqueue.posixmq.Queue(queue_name)
+metrics.Gauge('lb3_event_queue_depth', 'Webhook messages waiting to be handled, by priority',
+              lambda: [({ 'priority': name }, depth) for (name, depth) in event_queue.stats()['depth'].items()] if event_queue else [])
+
+def enqueue_messages(messages):
+    for message in messages:
+        event_queue.put(message)
+
+async def handle_messages(messages):
+    stream_data = {}
+    for message in messages:
+        logger.info("Queue message: '%s'", message)
         try:
-            # Do this to make sure other users can send stuff to us
-            os.chmod('/dev/mqueue%s' % queue_name, 0o666)
-        except PermissionError:
-            logger.warn("Couldn't set permissions on message queue")
-
-    def run(self):
-        logger.info("MQ receiving")
-        while True:
-            message = self.mq_queue.get()
-            logger.info("MQ message: '%s'" % message)
-            client.loop.call_soon_threadsafe(queue.put_nowait, message)
+            # Messages from the MQ are JSON text, the in-process receiver passes dicts
+            message_json = json.loads(message) if isinstance(message, str) else message
+            metrics.events.inc(event = 'message_%s' % message_json['action'])
+            if 'received' in message_json:
+                # Webhook receipt to here, including any MQ hop
+                metrics.stage_seconds.observe(time.time() - message_json['received'], stage = 'delivery')
+            server_id = message_json['args']['lb3.server'][0]
+            if server_id not in guild_index:
+                logger.error("Message for server %s, which I'm not serving", server_id)
+            elif message_json['action'] == 'stream':
+                stream_data.setdefault(server_id, []).extend(message_json['data'])
+            elif message_json['action'] == 'subscribe':
+                track_lease(server_id, message_json['args'])
+                await streamers.parse_subunsub_confirm(client, message_json, True)
+            elif message_json['action'] == 'unsubscribe':
+                if lease_scheduler:
+                    lease_scheduler.forget(server_id, message_json['args']['lb3.user_id'][0])
+                await streamers.parse_subunsub_confirm(client, message_json, False)
+        except:
+            logger.exception("Message badness")
+    # All the streams in a batch are announced together, in arrival order for each server
+    await asyncio.gather(*[twitch.parse_streams(client, guild_index[server_id].config, guild_index[server_id].server, { 'data': data },
+                                                max_age = event_queue.max_age)
+                           for (server_id, data) in stream_data.items()])
+
+def track_lease(server_id, args):
+    if lease_scheduler:
+        lease_scheduler.track(server_id, args['lb3.user_id'][0], subscriptions.lease_expires_at(args))
+
+async def renew_leases(server_id, user_ids):
+    guild = guild_index.get(server_id)
+    if not guild:
+        lease_scheduler.forget_server(server_id)
+        return
+    subs = subscriptions.registry.subs(server_id)
+    users = [subs[user_id].user() for user_id in user_ids if user_id in subs]
+    unknown = [('id', user_id) for user_id in user_ids if user_id not in subs]
+    if unknown:
+        users.extend(await twitch.lookup_users(guild.config, unknown) or [])
+    if users:
+        await twitch.sub_unsub_user(guild.config, None, True, users)
+
+async def subscription_task(interval):
+    # Catches leases taken out before this start up, and anything confirmations missed
+    while not client.is_closed:
+        try:
+            removed = None
+            if guild_index:
+                removed = await subscriptions.registry.reconcile(dict((server_id, guild.config)
+                                                                      for (server_id, guild) in guild_index.items()))
+            if (removed is not None) and lease_scheduler:
+                for (server_id, user_ids) in removed.items():
+                    for user_id in user_ids:
+                        lease_scheduler.forget(server_id, user_id)
+                    for sub in subscriptions.registry.subs(server_id).values():
+                        lease_scheduler.track(server_id, sub.user_id, sub.expires_at)
+        except:
+            logger.exception("Subscription reconcile badness")
+        await asyncio.sleep(interval)
 
 async def mq_handler_task():
     await client.wait_until_ready()
     logger.info("Waiting for a message")
     while not client.is_closed:
-        message = await queue.get()
-        logger.info("Queue message: '%s'" % message)
+        messages = await event_queue.get_batch()
         try:
-            message_json = json.loads(message)
-            if message_json['action'] == 'stream':
-                await twitch.parse_streams(client, config, server, message_json)
-            elif message_json['action'] == 'subscribe':
-                await streamers.parse_subunsub_confirm(client, message_json, True)
-            elif message_json['action'] == 'unsubscribe':
-                await streamers.parse_subunsub_confirm(client, message_json, False)
+            await handle_messages(messages)
         except:
             logger.exception("Message badness")
 
@@ -94,38 +163,53 @@ async def send_help_message(channel):
     embed.add_field(name='list', value='List Twitch users who will be announced', inline=False)
     embed.add_field(name='resub', value='Resubscribe all currently announced Twitch users', inline=False)
     embed.add_field(name='trello [Some brilliant idea]', value='Add a new card to Trello', inline=False)
+    embed.add_field(name='profile [seconds|stop]', value='Profile the bot for a while and write out the results', inline=False)
     embed.add_field(name='[status|playing|streaming|listening|watching] <status>', value="Set bot's status text", inline=False)
-    await client.send_message(channel, content='At your service', embed=embed)
+    outbox.actions.post(outbox.REPLY, client.send_message, channel, content='At your service', embed=embed)
 
 async def set_status(status, text):
-    logger.info("Status: %d:%s" % (status, text))
+    logger.info("Status: %d:%s", status, text)
     game = discord.Game(name = text, type = status, url = 'https://www.twitch.tv/communities/jdubzy')
     await client.change_presence(game = game)
     return (None, '\U0001F44D')
 
 async def lb3_add_command(client, message, param_text, params):
-    (response, ids) = await twitch.sub_user(config, params)
+    (response, ids) = await twitch.sub_user(guild_index[message.server.id].config, params)
     if ids:
         await streamers.add_streamer(message, ids)
     return (response, None)
 
 async def lb3_remove_command(client, message, param_text, params):
-    (response, ids) = await twitch.unsub_user(config, params)
+    (response, ids) = await twitch.unsub_user(guild_index[message.server.id].config, params)
     if ids:
         await streamers.remove_streamer(message, ids)
     return (response, None)
 
 async def lb3_announce_command(client, message, param_text, params):
-    return await twitch.announce_user(client, config, server, params)
+    guild = guild_index[message.server.id]
+    return await twitch.announce_user(client, guild.config, guild.server, params)
 
 async def lb3_list_command(client, message, param_text, params):
-    return await twitch.list_subs(client, config)
+    return await subscriptions.list_subs(client, guild_index[message.server.id].config)
 
 async def lb3_resub_command(client, message, param_text, params):
-    return await twitch.resub(client, config)
+    return await subscriptions.resub(client, guild_index[message.server.id].config)
 
 async def lb3_trello_command(client, message, param_text, params):
-    return await trello.create_card(config, param_text)
+    # Acknowledged straight away; the spool gets it to Trello
+    return trello.queue_card(guild_index[message.server.id].config, param_text)
+
+async def lb3_profile_command(client, message, param_text, params):
+    if params and (params[0] == 'stop'):
+        report_path = profiler.session.stop()
+        return ("Profile written to %s" % report_path if report_path else "I wasn't profiling", None)
+    if params and not params[0].isdigit():
+        return ("profile [seconds|stop]", None)
+    def profile_done(report_path):
+        if report_path:
+            outbox.actions.post(outbox.REPLY, client.send_message, message.channel, "Profile written to %s" % report_path)
+    report_path = profiler.session.start(client.loop, int(params[0]) if params else None, profile_done)
+    return ("Profiling until %s, report to %s" % (time.strftime('%H:%M:%S', time.localtime(profiler.session.ends)), report_path), None)
 
 async def lb3_status_command(client, message, param_text, params):
     return await set_status(0, param_text)
@@ -146,101 +230,285 @@ async def lb3_watching_command(client, message, param_text, params):
 
 @client.event
 async def on_message(message):
-    # Only interested in our server
-    if message.server != server:
+    # Only interested in our servers
+    guild = guild_index.get(message.server.id) if message.server else None
+    if not guild:
+        return
+
+    if guild.chat_channel_in and (message.channel == guild.chat_channel_in):
+        if message.author != client.user:
+            outbox.actions.post(outbox.RELAY, client.send_message, guild.chat_channel_out, message.content)
+        return
+
+    # Most messages don't mention the bot, so drop those before anything else
+    if command_router.marker not in message.content:
+        if (check_message is not default_check_message) and (message.author != client.user):
+            await check_message(client, message)
         return
 
     # we do not want the bot to reply to itself
     if message.author == client.user:
         return
 
-    if message.channel == chat_channel_in:
-        await client.send_message(chat_channel_out, message.content)
+    config_channel = message.channel in guild.config_channels
+    (command_func, param_text, params) = command_router.route(message.content, config_channel)
+    response = None
+    emote = None
+    show_help = config_channel
+    if command_func:
+        show_help = False
+        metrics.events.inc(event = 'command')
+        with metrics.stage_seconds.time(stage = 'command', command = command_func.__name__), \
+             profiler.session.timed('command', command_func.__name__):
+            (response, emote) = await command_func(client, message, param_text, params)
+    if show_help:
+        await send_help_message(message.channel)
         return
+    if response:
+        if response != "IGNORE":
+            outbox.actions.post(outbox.REPLY, client.send_message, message.channel, response)
+    if emote:
+        outbox.actions.post(outbox.TIDY, client.add_reaction, message, emote)
+    if not response and not emote and not await check_message(client, message):
+        response = "%s %s!" % (guild.config['discord']['greeting'], message.author.mention)
+        outbox.actions.post(outbox.REPLY, client.send_message, message.channel, response)
 
-    bot_user_marker = "<@%s>" % client.user.id
-    if bot_user_marker in message.content:
-        response = None
-        emote = None
-        command = message.content.replace(bot_user_marker, '').lstrip()
-        elements = command.split()
-        command_func = None
-        show_help = False
-        if message.channel in config_channels:
-            show_help = True
-            if len(elements) > 0:
-                command_func = 'lb3_%s_command' % elements[0]
-        elif len(elements) > 0:
-            command_func = 'lb3_%s_all_command' % elements[0]
-        if command_func and (command_func in commands):
-            logging.debug('command=%s' % command)
-            logging.debug('elements=%s' % elements)
-            logging.debug('command_func=%s' % command_func)
-            if command_func in commands:
-                show_help = False
-                param_text = command.replace(elements[0], '', 1).lstrip()
-                (response, emote) = await commands[command_func](client, message, param_text, elements[1:])
-        if show_help:
-            await send_help_message(message.channel)
-            return
-        if response:
-            if response != "IGNORE":
-                await client.send_message(message.channel, response)
-        if emote:
-            await client.add_reaction(message, emote)
-        if not response and not emote and not await check_message(client, message):
-            response = "%s %s!" % (config['discord']['greeting'], message.author.mention)
-            await client.send_message(message.channel, response)
-    else:
-        await check_message(client, message)
-
-def find_channels(channel_names):
-    channels = []
-    for name in channel_names:
-        channel = discord.utils.get(server.channels, name = name)
-        if channel:
-            logger.info("Config channel: %s" % channel)
-            channels.append(channel)
-    return channels
+@client.event
+async def on_channel_create(channel):
+    guilds.channel_created(channel)
+    resolve_channels(channel)
+
+@client.event
+async def on_channel_delete(channel):
+    guilds.channel_deleted(channel)
+    resolve_channels(channel)
+
+@client.event
+async def on_channel_update(before, after):
+    guilds.channel_updated(before, after)
+    resolve_channels(after)
+
+def resolve_channels(channel):
+    # A config channel may have gone, or a channel may now have a configured name
+    server = getattr(channel, 'server', None)
+    guild = guild_index.get(server.id) if server else None
+    if guild:
+        guild.configure(guild.config)
+
+def serve_guild(ser, guild_config):
+    logger.info("Found server '%s' (%s)", ser.name, ser.id)
+    guild = guilds.Guild(ser, guild_config)
+    guild.mq_reader = mqreader.MqReader('/bottington_%s' % ser.id, enqueue_messages, client.loop)
+    guild.mq_reader.start()
+    guild_index[ser.id] = guild
+
+def reload_config():
+    """Re-read the config file and apply the per-server settings: channels,
+    config channels, chat relay, greeting and so on, and servers added or
+    removed. Connection settings (token, http, webhook-receiver, metrics,
+    logging) still need a restart. Nothing here waits on the event loop, so
+    handlers only ever see the old config or the new one."""
+    global config
+    global config_mtime
+    try:
+        config_mtime = os.stat(config_file).st_mtime
+        with open(config_file, 'r') as infile:
+            new_config = json.load(infile)
+        configs = guilds.guild_configs(new_config)
+    except:
+        logger.exception("Config reload badness, keeping the old config")
+        return
+    logger.info("Reloading config from '%s'", config_file)
+    for server_id in list(guild_index):
+        if server_id not in configs:
+            logger.info("No longer serving %s", server_id)
+            guild = guild_index.pop(server_id)
+            if guild.mq_reader:
+                guild.mq_reader.stop()
+    for ser in client.servers:
+        if ser.id in guild_index:
+            guild_index[ser.id].configure(configs[ser.id])
+        elif ser.id in configs:
+            serve_guild(ser, configs[ser.id])
+    if webhook_receiver:
+        webhook_receiver.server_ids = set(guild_index)
+    if 'trello' in new_config:
+        trello.spool.config = new_config
+    profiler.session.configure(new_config)
+    config = new_config
+
+def control_guilds(args):
+    """The guild named by a leading server ID in args, or every guild, and the rest of args."""
+    if args and (args[0] in guild_index):
+        return ([guild_index[args[0]]], args[1:])
+    return (list(guild_index.values()), args)
+
+async def control_resub(args):
+    (targets, args) = control_guilds(args)
+    results = {}
+    for guild in targets:
+        results[guild.server.id] = (await subscriptions.resub(client, guild.config))[0]
+    return results
+
+async def control_list(args):
+    (targets, args) = control_guilds(args)
+    results = {}
+    for guild in targets:
+        results[guild.server.id] = (await subscriptions.list_subs(client, guild.config))[0]
+    return results
+
+async def control_notify(args):
+    (targets, args) = control_guilds(args)
+    text = ' '.join(args) or "Ironing complete. You're ready to go, sir!"
+    sent = {}
+    for guild in targets:
+        if guild.notify_channel:
+            await outbox.actions.call(outbox.REPLY, client.send_message, guild.notify_channel, text)
+            sent[guild.server.id] = guild.notify_channel.name
+    if not sent:
+        # An error, so whatever's waiting on the notification knows it didn't go
+        if not guild_index:
+            raise Exception("Not connected to Discord yet, nothing sent")
+        raise Exception("No notify channel, nothing sent")
+    return sent
+
+async def control_stats(args):
+    return { 'servers':        dict((server_id, guild.server.name) for (server_id, guild) in guild_index.items()),
+             'queue':          event_queue.stats() if event_queue else None,
+             'outbox':         outbox.actions.stats(),
+             'leases':         lease_scheduler.stats() if lease_scheduler else None,
+             'trello_pending': len(trello.spool.pending),
+             'dedup':          webhook.dedup_stats(),
+             'caches':         twitch.cache_stats(),
+             'stream_records': len(twitch.stream_state.records) }
+
+async def control_metrics(args):
+    return metrics.render()
+
+async def control_profile(args):
+    if args and (args[0] == 'stop'):
+        return profiler.session.stop()
+    if args and (args[0] == 'status'):
+        return profiler.session.status()
+    profiler.session.start(client.loop, float(args[0]) if args else None)
+    return profiler.session.status()
+
+async def control_reload(args):
+    reload_config()
+    return sorted(guild_index)
+
+control_commands = { 'resub':   control_resub,
+                     'list':    control_list,
+                     'notify':  control_notify,
+                     'stats':   control_stats,
+                     'metrics': control_metrics,
+                     'profile': control_profile,
+                     'reload':  control_reload }
+
+async def config_watch_task(interval):
+    await client.wait_until_ready()
+    while not client.is_closed:
+        await asyncio.sleep(interval)
+        try:
+            if os.stat(config_file).st_mtime != config_mtime:
+                reload_config()
+        except OSError:
+            logger.exception("Config watch badness")
 
 @client.event
 async def on_ready():
-    global server
-    global config_channels
-    global chat_channel_in
-    global chat_channel_out
     global check_message
-    global commands
-    logger.info("Logged in as '%s' '%s''" % (client.user.name, client.user.id))
-    if not server:
+    global command_router
+    global webhook_receiver
+    logger.info("Logged in as '%s' '%s''", client.user.name, client.user.id)
+    # on_ready comes again after a reconnect; set up only the first time
+    if command_router is None:
+        configs = guilds.guild_configs(config)
         for ser in client.servers:
-            dconf = config['discord']
-            if ser.id == dconf['server']:
-                logger.info("Found server '%s' (%s)" % (ser.name, ser.id))
-                server = ser
-                config_channels = find_channels(dconf['config_channels'])
-                if ('chat_channel_in' in dconf) and ('chat_channel_out' in dconf):
-                    chat_channel_in = discord.utils.get(server.channels, name = dconf['chat_channel_in'])
-                    chat_channel_out = discord.utils.get(server.channels, name = dconf['chat_channel_out'])
-                func_re = re.compile(r'lb3_.*_command', re.IGNORECASE)
-                for func in globals():
-                    if func_re.match(func):
-                        logger.info("Found func %s" % func)
-                        commands[func] = globals()[func]
-                if ('extensions' in dconf):
-                    ext_module = __import__(dconf['extensions'])
-                    ext_init = getattr(ext_module, 'lb3_extension_init')
-                    ext_init(config)
-                    check_message = getattr(ext_module, 'check_message')
-                    for func in dir(ext_module):
-                        if func_re.match(func):
-                            logger.info("Found func %s" % func)
-                            commands[func] = getattr(ext_module, func)
-                mq_thread = MqReceiveThread()
-                mq_thread.start()
-
-loop = client.loop
-queue = asyncio.Queue(loop = loop)
-loop.create_task(mq_handler_task())
-
-client.run(config['discord']['token'])
+            if ser.id in configs:
+                serve_guild(ser, configs[ser.id])
+        if not guild_index:
+            # A config reload can still add one, so carry on setting up
+            logger.warning("None of the configured servers are here")
+        dconf = config['discord']
+        new_router = router.CommandRouter(client.user.id)
+        new_router.add_commands(globals())
+        if ('extensions' in dconf):
+            ext_module = __import__(dconf['extensions'])
+            ext_init = getattr(ext_module, 'lb3_extension_init')
+            ext_init(config)
+            check_message = getattr(ext_module, 'check_message')
+            new_router.add_commands(vars(ext_module))
+        command_router = new_router
+        if 'webhook-receiver' in config:
+            webhook_receiver = receiver.WebhookReceiver(config, guild_index.keys(), lambda message: enqueue_messages([message]), client.loop)
+            await webhook_receiver.start()
+        sub_conf = config.get('subscriptions', {})
+        client.loop.create_task(subscription_task(sub_conf.get('reconcile-interval', subscriptions.DEFAULT_RECONCILE_INTERVAL)))
+        if lease_scheduler:
+            client.loop.create_task(lease_scheduler.run())
+
+def main():
+    global event_queue
+    global metrics_server
+    global lease_scheduler
+    global control_server
+    loop = client.loop
+    event_queue = eventqueue.EventQueue.from_config(config)
+    webclient.open_session(config, loop)
+    outbox.actions.configure(config)
+    profiler.session.configure(config)
+    if 'trello' in config:
+        trello.spool.open(config)
+        loop.create_task(trello.spool.run())
+    if 'stream-state' in config:
+        state_conf = config['stream-state']
+        twitch.stream_state.open(state_conf['file'], state_conf.get('max-age', streamstate.DEFAULT_MAX_AGE))
+    if 'metrics' in config:
+        metrics_server = metrics.MetricsServer(config, loop)
+        loop.run_until_complete(metrics_server.start())
+    lease_conf = config.get('leases', {})
+    if lease_conf.get('renew', True):
+        lease_scheduler = leases.LeaseScheduler(renew_leases, lease_conf.get('margin', leases.DEFAULT_MARGIN),
+                                                lease_conf.get('spread', leases.DEFAULT_SPREAD),
+                                                lease_conf.get('retry', leases.DEFAULT_RETRY))
+    loop.create_task(mq_handler_task())
+    try:
+        loop.add_signal_handler(signal.SIGHUP, reload_config)
+        loop.add_signal_handler(signal.SIGUSR1, profiler.session.toggle, loop)
+    except (NotImplementedError, AttributeError):
+        logger.warning("No SIGHUP here, config reload by file watch only")
+    if 'control' in config:
+        control_server = control.ControlServer(config, control_commands, loop)
+        loop.run_until_complete(control_server.start())
+    if config.get('config-watch'):
+        loop.create_task(config_watch_task(config['config-watch']))
+
+    # Equivalent of client.run(), but closing the HTTP session before the loop goes away
+    try:
+        loop.run_until_complete(client.start(config['discord']['token']))
+    except KeyboardInterrupt:
+        loop.run_until_complete(client.logout())
+        pending = asyncio.gather(*asyncio.Task.all_tasks(loop = loop), loop = loop)
+        pending.cancel()
+        try:
+            loop.run_until_complete(pending)
+        except:
+            pass
+    finally:
+        for guild in guild_index.values():
+            if guild.mq_reader:
+                guild.mq_reader.stop()
+        if webhook_receiver:
+            loop.run_until_complete(webhook_receiver.stop())
+        if metrics_server:
+            loop.run_until_complete(metrics_server.stop())
+        if control_server:
+            loop.run_until_complete(control_server.stop())
+        profiler.session.stop()
+        loop.run_until_complete(outbox.actions.stop())
+        loop.run_until_complete(webclient.close_session())
+        loop.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Unix-domain control socket, so local tools can drive the bot directly rather
+# than posting commands through a Discord webhook for it to read back
+
+import os
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger('control')
+
+DEFAULT_SOCKET = '/run/lb3/bottington.sock'
+
+class ControlServer:
+    """Takes one JSON request per line, { "command": name, "args": [...] },
+    and answers each with one JSON line, { "ok": true, "result": ... } or
+    { "ok": false, "error": text }.
+
+    commands maps each command name to a coroutine function taking the args
+    and returning something JSON can encode.
+    """
+    def __init__(self, config, commands, loop):
+        control_conf = config['control']
+        self.path = control_conf.get('socket', DEFAULT_SOCKET)
+        self.mode = int(str(control_conf.get('mode', '600')), 8)
+        self.commands = commands
+        self.loop = loop
+        self.server = None
+
+    async def start(self):
+        try:
+            # Left behind if we didn't shut down cleanly
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self.handle_connection, self.path)
+        os.chmod(self.path, self.mode)
+        logger.info("Control socket at %s", self.path)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self.handle_request(line)
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except:
+            logger.exception("Control connection badness")
+        finally:
+            writer.close()
+
+    async def handle_request(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            name = request['command']
+            args = request.get('args', [])
+        except (ValueError, KeyError, TypeError):
+            return { 'ok': False, 'error': 'Bad request' }
+        command = self.commands.get(name)
+        if not command:
+            return { 'ok': False, 'error': "No such command '%s', try: %s" % (name, ' '.join(sorted(self.commands))) }
+        logger.info("Control command: %s %s", name, args)
+        try:
+            return { 'ok': True, 'result': await command(args) }
+        except Exception as e:
+            logger.exception("Control command badness")
+            return { 'ok': False, 'error': str(e) or e.__class__.__name__ }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import collections
+import asyncio
+import logging
+import dateutil.parser
+
+import metrics
+
+logger = logging.getLogger('eventqueue')
+
+# Priorities, most urgent first. Confirmations are cheap and keep leases and
+# the subscription registry right, so they go ahead of announcements.
+PRIORITIES = { 'subscribe': 0, 'unsubscribe': 0, 'stream': 1 }
+DEFAULT_PRIORITY = 2
+PRIORITY_NAMES = { 0: 'confirm', 1: 'stream', 2: 'other' }
+
+DEFAULT_MAX_SIZE = 10000
+# Most messages handed over at once, as for mqreader.MAX_BATCH, so the end of a
+# big backlog isn't stuck behind the whole of it being announced
+DEFAULT_MAX_BATCH = 64
+# Streams that started longer ago than this aren't worth announcing
+DEFAULT_MAX_AGE = 15 * 60
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest')
+
+def started_at(entry):
+    try:
+        return dateutil.parser.parse(entry['started_at']).timestamp()
+    except (KeyError, ValueError, OverflowError):
+        return None
+
+class EventQueue:
+    """Bounded queue of messages from the webhook, taken in priority order
+    and, within a priority, in arrival order.
+
+    When full, "drop-oldest" makes room by dropping the oldest message of the
+    least urgent priority queued, and "drop-newest" turns the new message away
+    instead (unless it's more urgent than something that can go). Streams that
+    started more than max_age seconds ago are dropped when taken, and
+    parse_streams checks again just before announcing.
+    """
+    def __init__(self, max_size = DEFAULT_MAX_SIZE, overflow = 'drop-oldest', max_age = DEFAULT_MAX_AGE,
+                 max_batch = DEFAULT_MAX_BATCH):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s'" % overflow)
+        self.max_size = max_size
+        self.overflow = overflow
+        self.max_age = max_age
+        self.max_batch = max_batch
+        # Entries are [priority, seq, queued, message]; a dropped one has its message set to None
+        self.heap = []
+        # The same entries by priority, oldest first, to find what to drop on overflow
+        self.fifos = dict((priority, collections.deque()) for priority in PRIORITY_NAMES)
+        self.seq = 0
+        self.size = 0
+        self.depths = dict((priority, 0) for priority in PRIORITY_NAMES)
+        self.dropped = {}
+        self.wakeup = None
+
+    @classmethod
+    def from_config(cls, config):
+        queue_conf = config.get('event-queue', {})
+        return cls(queue_conf.get('max-size', DEFAULT_MAX_SIZE), queue_conf.get('overflow', 'drop-oldest'),
+                   queue_conf.get('max-age', DEFAULT_MAX_AGE), queue_conf.get('max-batch', DEFAULT_MAX_BATCH))
+
+    def __len__(self):
+        return self.size
+
+    def drop(self, message, reason):
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        metrics.events.inc(event = 'event_dropped', reason = reason)
+        logger.warning("Dropping %s message (%s)", message.get('action'), reason)
+
+    def put(self, message):
+        """Queue message, returning False if it was turned away."""
+        priority = PRIORITIES.get(message.get('action'), DEFAULT_PRIORITY)
+        if self.size >= self.max_size:
+            victim = self.least_urgent()
+            if ((victim is None) or (victim[0] < priority) or
+                ((self.overflow == 'drop-newest') and (victim[0] == priority))):
+                self.drop(message, 'overflow')
+                return False
+            self.drop(victim[3], 'overflow')
+            self.remove(victim)
+        self.seq += 1
+        entry = [priority, self.seq, time.monotonic(), message]
+        heapq.heappush(self.heap, entry)
+        self.fifos[priority].append(entry)
+        self.size += 1
+        self.depths[priority] += 1
+        if self.wakeup:
+            self.wakeup.set()
+        return True
+
+    def least_urgent(self):
+        """The oldest queued entry of the least urgent priority."""
+        for priority in sorted(self.fifos, reverse = True):
+            fifo = self.fifos[priority]
+            while fifo and (fifo[0][3] is None):
+                fifo.popleft()
+            if fifo:
+                return fifo[0]
+        return None
+
+    def remove(self, entry):
+        # Left in the heap and its fifo, and skipped when it comes up
+        entry[3] = None
+        self.size -= 1
+        self.depths[entry[0]] -= 1
+
+    def fresh(self, message):
+        """message without streams that started too long ago, or None if
+        nothing's left of it."""
+        if (message.get('action') != 'stream') or not self.max_age or not message.get('data'):
+            return message
+        oldest = time.time() - self.max_age
+        data = [entry for entry in message['data'] if (started_at(entry) or oldest) >= oldest]
+        if not data:
+            self.drop(message, 'stale')
+            return None
+        if len(data) < len(message['data']):
+            message = dict(message, data = data)
+        return message
+
+    def get_nowait(self):
+        """The most urgent message, or None if there are none."""
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[3] is None:
+                continue
+            message = entry[3]
+            self.remove(entry)
+            # Taken in arrival order within a priority, so dropping the
+            # consumed entries from the front keeps the fifo from growing
+            fifo = self.fifos[entry[0]]
+            while fifo and (fifo[0][3] is None):
+                fifo.popleft()
+            metrics.stage_seconds.observe(time.monotonic() - entry[2], stage = 'queue_wait')
+            message = self.fresh(message)
+            if message is not None:
+                return message
+        return None
+
+    async def get_batch(self):
+        """Up to max_batch messages, most urgent first, waiting for something if need be."""
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            batch = []
+            while len(batch) < self.max_batch:
+                message = self.get_nowait()
+                if message is None:
+                    break
+                batch.append(message)
+            if batch:
+                return batch
+            await self.wakeup.wait()
+
+    def stats(self):
+        return { 'depth':   dict((PRIORITY_NAMES[priority], depth) for (priority, depth) in self.depths.items()),
+                 'dropped': dict(self.dropped) }
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger('guilds')
+
+def guild_configs(config):
+    """Per-server copies of config, keyed by Discord server ID.
+
+    The "discord" section of each copy is the top-level one overlaid with the
+    server's entry in "discord"/"servers", so a config naming a single
+    "server" works unchanged and settings shared by every server (token,
+    extensions, greeting...) only need giving once.
+    """
+    dconf = config['discord']
+    servers = dict(dconf.get('servers', {}))
+    if 'server' in dconf:
+        servers.setdefault(dconf['server'], {})
+    configs = {}
+    for (server_id, overrides) in servers.items():
+        guild_dconf = dict((key, value) for (key, value) in dconf.items() if key != 'servers')
+        guild_dconf.update(overrides)
+        guild_dconf['server'] = server_id
+        guild_config = dict(config)
+        guild_config['discord'] = guild_dconf
+        configs[server_id] = guild_config
+    return configs
+
+class ChannelIndex:
+    """A server's channels by name, kept up to date from the channel events
+    rather than searching server.channels for every look-up. Discord allows
+    several channels with one name; the first found wins, as with
+    discord.utils.get."""
+    def __init__(self, server):
+        self.by_name = {}
+        for channel in server.channels:
+            self.add(channel)
+
+    def add(self, channel):
+        self.by_name.setdefault(channel.name, []).append(channel)
+
+    def remove(self, channel, name = None):
+        name = channel.name if name is None else name
+        channels = [c for c in self.by_name.get(name, []) if c.id != channel.id]
+        if channels:
+            self.by_name[name] = channels
+        else:
+            self.by_name.pop(name, None)
+
+    def get(self, name):
+        channels = self.by_name.get(name)
+        return channels[0] if channels else None
+
+# ChannelIndex for each server, by server ID
+channel_indexes = {}
+
+def channel_index(server):
+    index = channel_indexes.get(server.id)
+    if index is None:
+        index = ChannelIndex(server)
+        channel_indexes[server.id] = index
+    return index
+
+def get_channel(server, name):
+    return channel_index(server).get(name)
+
+def channel_created(channel):
+    server = getattr(channel, 'server', None)
+    if server and (server.id in channel_indexes):
+        channel_indexes[server.id].add(channel)
+
+def channel_deleted(channel):
+    server = getattr(channel, 'server', None)
+    if server and (server.id in channel_indexes):
+        channel_indexes[server.id].remove(channel)
+
+def channel_updated(before, after):
+    server = getattr(after, 'server', None)
+    if server and (server.id in channel_indexes):
+        index = channel_indexes[server.id]
+        if before.name == after.name:
+            index.by_name[after.name] = [after if c.id == after.id else c for c in index.by_name.get(after.name, [])]
+        else:
+            index.remove(before)
+            index.add(after)
+
+def find_channels(server, channel_names):
+    channels = []
+    for name in channel_names:
+        channel = get_channel(server, name)
+        if channel:
+            logger.info("Config channel: %s", channel)
+            channels.append(channel)
+    return channels
+
+class Guild:
+    """A Discord server the bot serves, with its own config and channels."""
+    def __init__(self, server, config):
+        self.server = server
+        self.mq_reader = None
+        self.configure(config)
+
+    def configure(self, config):
+        """Resolve the channels named in config. Everything is worked out
+        before any of it is replaced, so handlers never see half of a change."""
+        dconf = config['discord']
+        config_channels = find_channels(self.server, dconf.get('config_channels', []))
+        chat_channel_in = None
+        chat_channel_out = None
+        if ('chat_channel_in' in dconf) and ('chat_channel_out' in dconf):
+            chat_channel_in = get_channel(self.server, dconf['chat_channel_in'])
+            chat_channel_out = get_channel(self.server, dconf['chat_channel_out'])
+        # Where control socket notifications go
+        notify_channel = get_channel(self.server, dconf['notify_channel']) if 'notify_channel' in dconf else None
+        if not notify_channel and config_channels:
+            notify_channel = config_channels[0]
+        (self.config, self.config_channels, self.chat_channel_in, self.chat_channel_out, self.notify_channel) = \
+            (config, config_channels, chat_channel_in, chat_channel_out, notify_channel)
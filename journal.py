@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+
+logger = logging.getLogger('journal')
+
+class Journal:
+    """Append-only JSON-lines file behind an in-memory table.
+
+    Each change is appended as one JSON object per line and replayed by the
+    owner on start-up. Once the file holds mostly superseded lines it is
+    rewritten from snapshot(), which returns the entries for the live table.
+    """
+    def __init__(self, path, snapshot, fsync = False):
+        self.path = path
+        self.snapshot = snapshot
+        self.fsync = fsync
+        self.file = None
+        self.lines = 0
+
+    def entries(self):
+        """The entries in the file, skipping lines that don't parse."""
+        try:
+            with open(self.path, 'r') as infile:
+                for line in infile:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Most likely a write cut short by a crash
+                        logger.warning("Skipping bad line in %s", self.path)
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        if self.file:
+            self.file.close()
+        entries = self.snapshot()
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as outfile:
+            for entry in entries:
+                outfile.write(json.dumps(entry) + '\n')
+            if self.fsync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.lines = len(entries)
+
+    def append(self, entry, live):
+        """Journal entry, compacting once there are many more lines than the
+        live entries the table holds. Raises OSError if it can't be written."""
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.lines += 1
+        if self.lines > 2 * live + 64:
+            self.compact()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
-import requests
-import json
 import sys
+import json
 
-# Read config
-config_file = sys.argv[1] if len(sys.argv) > 1 else 'lb3-conf.json'
-with open(config_file, 'r') as infile:
-    config = json.load(infile)
+import lb3ctl
 
-data = { 'username': 'Kryten', 'content':   "Ironing complete. You're ready to go, sir!" }
-headers = { 'Content-Type': 'application/json' }
-r = requests.post(config['kryten-webhook'], headers=headers, data=json.dumps(data))
-if r.status_code != 204:
-    print('Discord HTTP %d' % r.status_code)
-    print(r.text)
+NOTIFY_TEXT = "Ironing complete. You're ready to go, sir!"
+
+def webhook_notify(config_file):
+    """Post through kryten-webhook, for when the bot isn't there to ask,
+    e.g. it's been stopped. Returns an exit status like lb3ctl.main."""
+    with open(config_file, 'r') as infile:
+        config = json.load(infile)
+    if 'kryten-webhook' not in config:
+        return 2
+    import requests
+    data = { 'username': 'Kryten', 'content': NOTIFY_TEXT }
+    headers = { 'Content-Type': 'application/json' }
+    r = requests.post(config['kryten-webhook'], headers=headers, data=json.dumps(data))
+    if r.status_code != 204:
+        print('Discord HTTP %d' % r.status_code)
+        print(r.text)
+        return 1
+    return 0
+
+# Goes through the control socket, falling back to the Discord webhook if the bot can't be reached
+config_file = sys.argv[1] if len(sys.argv) > 1 else 'lb3-conf.json'
+status = lb3ctl.main(['-c', config_file, 'notify', NOTIFY_TEXT])
+if status == 2:
+    status = webhook_notify(config_file)
+sys.exit(status)
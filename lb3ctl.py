@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Command line client for the bot's control socket
+#   lb3ctl.py [-c lb3-conf.json] resub|list|notify|stats|metrics|reload [server ID] [args...]
+#   lb3ctl.py [-c lb3-conf.json] profile [seconds|stop|status]
+
+import sys
+import json
+import socket
+import argparse
+
+DEFAULT_SOCKET = '/run/lb3/bottington.sock'
+
+def socket_path(config_file):
+    with open(config_file, 'r') as infile:
+        config = json.load(infile)
+    return config.get('control', {}).get('socket', DEFAULT_SOCKET)
+
+def send_command(path, command, args, timeout = 60):
+    """Send one command and return the decoded response."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps({ 'command': command, 'args': args }) + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        sock.close()
+    return json.loads(response.decode('utf-8'))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Control a running Bottington")
+    parser.add_argument('-c', '--config', default = 'lb3-conf.json', help = 'config file naming the control socket')
+    parser.add_argument('-s', '--socket', help = 'control socket, overriding the config')
+    parser.add_argument('command')
+    parser.add_argument('args', nargs = '*')
+    args = parser.parse_args(argv)
+
+    path = args.socket or socket_path(args.config)
+    try:
+        response = send_command(path, args.command, args.args)
+    except (OSError, ValueError) as e:
+        print("Can't reach Bottington on %s: %s" % (path, e))
+        return 2
+    if not response['ok']:
+        print(response['error'])
+        return 1
+    result = response['result']
+    if isinstance(result, str):
+        print(result, end = '' if result.endswith('\n') else '\n')
+    else:
+        print(json.dumps(result, indent = 2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import time
+import heapq
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger('leases')
+
+DEFAULT_MARGIN = 24 * 60 * 60
+DEFAULT_SPREAD = 24 * 60 * 60
+DEFAULT_RETRY = 15 * 60
+
+class LeaseScheduler:
+    """Renews webhook subscriptions before their leases run out.
+
+    Each subscription's renewal time goes on a heap. Renewals are due "margin"
+    seconds before expiry, less a random jitter of up to "spread" seconds, so
+    leases taken out together (e.g. by resub) are renewed spread out rather than
+    in another burst. If no fresh lease has been confirmed "retry" seconds
+    after a renewal, it is tried again.
+    """
+    def __init__(self, renew_func, margin = DEFAULT_MARGIN, spread = DEFAULT_SPREAD, retry = DEFAULT_RETRY):
+        self.renew_func = renew_func
+        self.margin = margin
+        self.spread = spread
+        self.retry = retry
+        # Entries are (renew_at, expires_at, server_id, user_id); ones whose
+        # expiry no longer matches self.expiries are stale and skipped
+        self.heap = []
+        self.expiries = {}
+        self.wakeup = asyncio.Event()
+
+    def track(self, server_id, user_id, expires_at):
+        if self.expiries.get((server_id, user_id)) == expires_at:
+            return
+        renew_at = expires_at - self.margin - random.uniform(0, self.spread)
+        self.expiries[(server_id, user_id)] = expires_at
+        self.schedule(renew_at, expires_at, server_id, user_id)
+        logger.debug("Lease %s/%s expires %s", server_id, user_id, time.ctime(expires_at))
+
+    def forget(self, server_id, user_id):
+        self.expiries.pop((server_id, user_id), None)
+
+    def forget_server(self, server_id):
+        for key in [key for key in self.expiries if key[0] == server_id]:
+            del self.expiries[key]
+
+    def schedule(self, renew_at, expires_at, server_id, user_id):
+        heapq.heappush(self.heap, (renew_at, expires_at, server_id, user_id))
+        if self.heap[0][0] == renew_at:
+            self.wakeup.set()
+
+    def pop_due(self):
+        """Due, still current, renewals grouped by server."""
+        now = time.time()
+        due = {}
+        while self.heap and (self.heap[0][0] <= now):
+            (renew_at, expires_at, server_id, user_id) = heapq.heappop(self.heap)
+            if self.expiries.get((server_id, user_id)) != expires_at:
+                continue
+            due.setdefault(server_id, []).append(user_id)
+            # Try again later unless the new lease is confirmed first
+            self.schedule(now + self.retry, expires_at, server_id, user_id)
+        return due
+
+    def stats(self):
+        next_renewal = min((entry[0] for entry in self.heap
+                            if self.expiries.get((entry[2], entry[3])) == entry[1]), default = None)
+        return { 'leases': len(self.expiries), 'next_renewal': next_renewal }
+
+    async def run(self):
+        logger.info("Lease renewal running")
+        while True:
+            for (server_id, user_ids) in self.pop_due().items():
+                logger.info("Renewing %d leases for %s", len(user_ids), server_id)
+                try:
+                    await self.renew_func(server_id, user_ids)
+                except:
+                    logger.exception("Lease renewal badness")
+            self.wakeup.clear()
+            delay = (self.heap[0][0] - time.time()) if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Logging through a queue, so handlers write to disk on their own thread
+
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# Longest log message kept, in characters, before it's cut short
+DEFAULT_MAX_LENGTH = 4096
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a QueueListener, cutting long messages (whole
+    notification payloads and the like) down to max_length first. Tracebacks
+    are kept in full."""
+    def __init__(self, log_queue, max_length = DEFAULT_MAX_LENGTH):
+        super().__init__(log_queue)
+        self.max_length = max_length
+        self.exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Formatted here, as the arguments may have changed by the time the
+        # listener gets to it, but only for records that pass the level checks
+        message = record.getMessage()
+        if self.max_length and (len(message) > self.max_length):
+            message = '%s... [%d more]' % (message[:self.max_length], len(message) - self.max_length)
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+    def format(self, record):
+        entry = { 'time':    record.created,
+                  'level':   record.levelname,
+                  'logger':  record.name,
+                  'message': record.getMessage() }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry)
+
+def start_logging(handler, level, logger_name = None, fmt = None, utc = False, json_format = False,
+                  max_length = DEFAULT_MAX_LENGTH):
+    """Log logger_name (the root logger by default) to handler through a queue.
+    Returns the QueueListener, which is stopped at exit to flush the queue."""
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(fmt)
+        if utc:
+            formatter.converter = time.gmtime
+    handler.setFormatter(formatter)
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger = logging.getLogger(logger_name)
+    logger.addHandler(TruncatingQueueHandler(log_queue, max_length))
+    logger.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
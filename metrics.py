@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# In-process counters and latency histograms, served in the Prometheus text format
+
+import time
+import logging
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+registry = []
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (name, value) in labels)
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [ '# HELP %s %s' % (self.name, self.help_text),
+                  '# TYPE %s counter' % self.name ]
+        for (key, value) in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name, format_labels(key), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # label key -> [per-bucket counts, sum, count]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = [[0] * len(self.buckets), 0.0, 0]
+            self.values[key] = entry
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = [ '# HELP %s %s' % (self.name, self.help_text),
+                  '# TYPE %s histogram' % self.name ]
+        for (key, (counts, total, count)) in sorted(self.values.items()):
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(key + (('le', repr(bound)),)), cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(key + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %.6f' % (self.name, format_labels(key), total))
+            lines.append('%s_count%s %d' % (self.name, format_labels(key), count))
+        return lines
+
+class Gauge:
+    """Gauge read when scraped; value_func returns a list of (labels dict, value)."""
+    def __init__(self, name, help_text, value_func):
+        self.name = name
+        self.help_text = help_text
+        self.value_func = value_func
+        registry.append(self)
+
+    def render(self):
+        lines = [ '# HELP %s %s' % (self.name, self.help_text),
+                  '# TYPE %s gauge' % self.name ]
+        try:
+            for (labels, value) in self.value_func():
+                lines.append('%s%s %s' % (self.name, format_labels(tuple(sorted(labels.items()))), value))
+        except:
+            logger.exception("Gauge %s badness", self.name)
+        return lines
+
+class CounterFunc(Gauge):
+    """Counter kept elsewhere and read when scraped; value_func returns a
+    list of (labels dict, value), each value only ever going up."""
+    def render(self):
+        lines = super().render()
+        lines[1] = '# TYPE %s counter' % self.name
+        return lines
+
+class Timer:
+    """Context manager observing the time spent in its block."""
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+        return False
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# The bot's own metrics
+stage_seconds = Histogram('lb3_stage_seconds', 'Time spent in each stage of the notification and command pipeline')
+events = Counter('lb3_events_total', 'Pipeline events by type')
+
+class MetricsServer:
+    """Serves render() at /metrics, configured by the "metrics" config section."""
+    def __init__(self, config, loop):
+        # Imported here so the CGI script can record metrics without loading aiohttp
+        from aiohttp import web
+        self.web = web
+        metrics_conf = config['metrics']
+        self.host = metrics_conf.get('host', '127.0.0.1')
+        self.port = metrics_conf.get('port', 9108)
+        self.loop = loop
+        self.app = web.Application(loop = loop)
+        self.app.router.add_route('GET', '/metrics', self.handle_metrics)
+        self.handler = None
+        self.server = None
+
+    async def start(self):
+        self.handler = self.app.make_handler()
+        self.server = await self.loop.create_server(self.handler, self.host, self.port)
+        logger.info("Metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_metrics(self, request):
+        return self.web.Response(text = render(), content_type = 'text/plain')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# Encoding for messages from twitch_webhook.py to the bot over the POSIX MQ.
+#
+# A message is reduced to the fields the bot uses, as compact JSON, zlib
+# compressed when that helps, and split into frames no bigger than the
+# queue's message size. Each frame is
+#
+#   magic "L3", version, flags, sender PID, message ID, frame index, frame count
+#
+# followed by its share of the body. Anything without the magic is taken to be
+# the older pickled JSON text, so messages queued by an older webhook script
+# are still read.
+
+import os
+import json
+import time
+import zlib
+import random
+import struct
+import logging
+
+logger = logging.getLogger('mqformat')
+
+MAGIC = b'L3'
+VERSION = 1
+FLAG_ZLIB = 0x01
+HEADER = struct.Struct('!2sBBIIHH')
+# Bodies shorter than this aren't worth compressing
+COMPRESS_MIN = 256
+# Seconds to wait for the rest of a chunked message
+REASSEMBLY_TIMEOUT = 30
+
+ACTIONS = { 'stream': 's', 'subscribe': '+', 'unsubscribe': '-' }
+ACTION_NAMES = dict((code, action) for (action, code) in ACTIONS.items())
+# What parse_streams reads from each stream, in the order they're sent
+STREAM_FIELDS = ('user_id', 'game_id', 'type', 'title', 'started_at')
+
+def compact(message):
+    args = message['args']
+    body = { 'a': ACTIONS[message['action']] }
+    if 'lb3.server' in args:
+        body['s'] = args['lb3.server'][0]
+    if 'lb3.user_id' in args:
+        body['u'] = args['lb3.user_id'][0]
+    if 'received' in message:
+        body['t'] = message['received']
+    if 'hub.lease_seconds' in args:
+        body['l'] = args['hub.lease_seconds'][0]
+    if 'data' in message:
+        body['d'] = [[entry.get(field) for field in STREAM_FIELDS] for entry in message['data']]
+    return body
+
+def expand(body):
+    """The message compact() was given, as far as the bot is concerned."""
+    args = {}
+    if 's' in body:
+        args['lb3.server'] = [body['s']]
+    if 'u' in body:
+        args['lb3.user_id'] = [body['u']]
+    if 'l' in body:
+        args['hub.lease_seconds'] = [body['l']]
+    message = { 'action': ACTION_NAMES[body['a']], 'args': args }
+    if 't' in body:
+        message['received'] = body['t']
+    if 'd' in body:
+        # Every field, None included, as compact() was given it
+        message['data'] = [dict(zip(STREAM_FIELDS, entry)) for entry in body['d']]
+    return message
+
+def encode(message, max_size):
+    """Frames for message, each at most max_size bytes."""
+    payload = json.dumps(compact(message), separators = (',', ':')).encode('utf-8')
+    flags = 0
+    if len(payload) >= COMPRESS_MIN:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            (payload, flags) = (compressed, FLAG_ZLIB)
+    chunk_size = max_size - HEADER.size
+    total = max(1, -(-len(payload) // chunk_size))
+    if total > 0xffff:
+        raise ValueError("Message too big for the MQ: %d bytes" % len(payload))
+    message_id = random.getrandbits(32)
+    pid = os.getpid()
+    return [HEADER.pack(MAGIC, VERSION, flags, pid, message_id, index, total) + payload[index * chunk_size:(index + 1) * chunk_size]
+            for index in range(total)]
+
+def legacy_text(data):
+    """The JSON text an older twitch_webhook.py pickled onto the queue. Only
+    a pickled str (BINUNICODE) is accepted, without unpickling anything."""
+    if data[:1] != b'X':
+        raise ValueError("Not an MQ message")
+    (length,) = struct.unpack_from('<I', data, 1)
+    return data[5:5 + length].decode('utf-8')
+
+class Decoder:
+    """Turns frames read off the MQ back into messages, holding on to the
+    frames of a chunked message until they've all arrived."""
+    def __init__(self):
+        # (pid, message ID) -> [first seen, frame count, flags, { index: chunk }]
+        self.partial = {}
+
+    def feed(self, data):
+        """The message data completes, or None."""
+        if data[:len(MAGIC)] != MAGIC:
+            return json.loads(legacy_text(data))
+        (magic, version, flags, pid, message_id, index, total) = HEADER.unpack_from(data)
+        if version != VERSION:
+            logger.error("Unknown MQ message version %d", version)
+            return None
+        chunk = data[HEADER.size:]
+        if total == 1:
+            return self.decode(flags, chunk)
+        now = time.monotonic()
+        self.expire(now)
+        key = (pid, message_id)
+        entry = self.partial.setdefault(key, [now, total, flags, {}])
+        entry[3][index] = chunk
+        if len(entry[3]) < total:
+            return None
+        del self.partial[key]
+        return self.decode(flags, b''.join(entry[3][i] for i in range(total)))
+
+    def decode(self, flags, payload):
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return expand(json.loads(payload.decode('utf-8')))
+
+    def expire(self, now):
+        for key in [key for (key, entry) in self.partial.items() if now - entry[0] > REASSEMBLY_TIMEOUT]:
+            logger.error("Dropping incomplete MQ message %s after %d of %d frames",
+                         key, len(self.partial[key][3]), self.partial[key][1])
+            del self.partial[key]
+
+class JsonText:
+    """Logs a message as JSON, only encoding it if the record is emitted."""
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return json.dumps(self.message)
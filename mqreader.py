@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import logging
+import ipcqueue.posixmq
+import ipcqueue.serializers
+
+import metrics
+import mqformat
+
+# Under bottington so the MQ message lines reach the bot log
+logger = logging.getLogger('bottington.mqreader')
+
+# Most messages handed over from a single wake-up
+MAX_BATCH = 64
+
+class MqReader:
+    """Reads the bot's POSIX message queue from the event loop.
+
+    On Linux a message queue descriptor is a file descriptor, so it is watched
+    with add_reader instead of blocking a thread on get(). Each wake-up drains
+    every pending message and passes them to deliver_batch as one list of
+    decoded messages.
+    """
+    def __init__(self, queue_name, deliver_batch, loop):
+        # Frames are decoded by mqformat, which also handles the older pickled JSON
+        self.mq_queue = ipcqueue.posixmq.Queue(queue_name, serializer = ipcqueue.serializers.RawSerializer)
+        self.decoder = mqformat.Decoder()
+        self.deliver_batch = deliver_batch
+        self.loop = loop
+        try:
+            # Do this to make sure other users can send stuff to us
+            os.chmod('/dev/mqueue%s' % queue_name, 0o666)
+        except OSError:
+            logger.warning("Couldn't set permissions on message queue")
+
+    def fileno(self):
+        # ipcqueue keeps the mqd_t from mq_open() here
+        return self.mq_queue._queue_id
+
+    def start(self):
+        logger.info("MQ receiving")
+        self.loop.add_reader(self.fileno(), self.drain)
+        # Pick up anything sent while we weren't listening
+        self.drain()
+
+    def stop(self):
+        self.loop.remove_reader(self.fileno())
+        self.mq_queue.close()
+
+    def drain(self):
+        batch = []
+        while len(batch) < MAX_BATCH:
+            try:
+                data = self.mq_queue.get_nowait()
+            except queue.Empty:
+                break
+            except ipcqueue.posixmq.QueueError:
+                logger.exception("MQ read badness")
+                break
+            try:
+                message = self.decoder.feed(data)
+            except Exception:
+                logger.exception("MQ message badness")
+                continue
+            if message is None:
+                # More frames to come
+                continue
+            logger.info("MQ message: '%s'", mqformat.JsonText(message))
+            batch.append(message)
+        if batch:
+            metrics.events.inc(len(batch), event = 'mq_dequeued')
+            self.deliver_batch(batch)
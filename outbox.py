@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Outbound Discord calls, queued by priority and paced to Discord's rate limits
+
+import time
+import heapq
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger('outbox')
+
+# Priorities, most urgent first
+ANNOUNCE = 0    # Go-live announcements and their edits
+REPLY = 1       # Responses to commands
+TIDY = 2        # Deleting old announcements, reactions
+RELAY = 3       # Chat relay
+PRIORITY_NAMES = { ANNOUNCE: 'announce', REPLY: 'reply', TIDY: 'tidy', RELAY: 'relay' }
+
+# Seconds an action may wait before it's dropped as stale, None to never drop
+DEFAULT_MAX_AGE = { ANNOUNCE: None, REPLY: 60, TIDY: 300, RELAY: 30 }
+
+# (requests, per seconds) for each channel, by client method; anything else
+# only counts against the global limit
+ROUTE_LIMITS = { 'send_message':   (5, 5.0),
+                 'edit_message':   (5, 5.0),
+                 'delete_message': (5, 1.0),
+                 'add_reaction':   (1, 0.25) }
+GLOBAL_LIMIT = (50, 1.0)
+
+class Bucket:
+    """Token bucket refilling at limit requests every per seconds."""
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.tokens = limit
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a request can be made, 0 if one can be now."""
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.per / self.limit
+
+    def take(self):
+        self.tokens -= 1
+
+class Action:
+    __slots__ = ('priority', 'func', 'args', 'kwargs', 'bucket_key', 'queued', 'future')
+
+    def __init__(self, priority, func, args, kwargs, future):
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # Messages are limited by their channel, channels by themselves
+        target = args[0] if args else None
+        target = getattr(target, 'channel', target)
+        self.bucket_key = (func.__name__, getattr(target, 'id', None))
+        self.queued = time.monotonic()
+        self.future = future
+
+class Outbox:
+    """Runs outbound Discord calls in priority order without exceeding the
+    per-channel route limits, so announcements aren't held up behind a burst of
+    deletes or reactions. Actions of one priority keep their order.
+
+    call() waits for the result; post() is fire-and-forget, logging any failure.
+    The dispatcher starts with the first action queued.
+    """
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.buckets = {}
+        self.global_bucket = Bucket(*GLOBAL_LIMIT)
+        self.max_age = dict(DEFAULT_MAX_AGE)
+        self.running = set()
+        self.wakeup = None
+        self.idle_event = None
+        self.task = None
+
+    def configure(self, config):
+        """Apply the optional "outbox" config section."""
+        max_age = config.get('outbox', {}).get('max-age', {})
+        for (priority, name) in PRIORITY_NAMES.items():
+            if name in max_age:
+                self.max_age[priority] = max_age[name]
+
+    def call(self, priority, func, *args, **kwargs):
+        future = asyncio.get_event_loop().create_future()
+        self.queue(Action(priority, func, args, kwargs, future))
+        return future
+
+    def post(self, priority, func, *args, **kwargs):
+        self.queue(Action(priority, func, args, kwargs, None))
+
+    def queue(self, action):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.idle_event = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+        self.seq += 1
+        heapq.heappush(self.heap, (action.priority, self.seq, action))
+        self.idle_event.clear()
+        self.wakeup.set()
+
+    def stats(self):
+        return { 'pending': len(self.heap), 'running': len(self.running) }
+
+    async def join(self):
+        """Wait for every queued action to finish."""
+        if self.task is not None:
+            await self.idle_event.wait()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = Bucket(*ROUTE_LIMITS.get(key[0], GLOBAL_LIMIT))
+            self.buckets[key] = bucket
+        return bucket
+
+    def dispatch(self):
+        """Start every action that can go now. Returns seconds until the next
+        one could, or None if nothing is waiting."""
+        now = time.monotonic()
+        held = []
+        wait = None
+        while self.heap:
+            delay = self.global_bucket.delay(now)
+            if delay:
+                wait = delay
+                break
+            entry = heapq.heappop(self.heap)
+            action = entry[2]
+            max_age = self.max_age.get(action.priority)
+            if (max_age is not None) and (now - action.queued > max_age):
+                logger.warning("Dropping stale %s %s", PRIORITY_NAMES.get(action.priority), action.func.__name__)
+                metrics.events.inc(event = 'outbox_dropped', priority = PRIORITY_NAMES.get(action.priority))
+                if action.future:
+                    action.future.cancel()
+                continue
+            bucket = self.bucket(action.bucket_key)
+            delay = bucket.delay(now)
+            if delay:
+                # Its channel's route is used up; lower priorities elsewhere can still go
+                held.append(entry)
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            bucket.take()
+            self.global_bucket.take()
+            metrics.stage_seconds.observe(now - action.queued, stage = 'outbox_wait')
+            task = asyncio.ensure_future(self.perform(action))
+            self.running.add(task)
+            task.add_done_callback(self.done)
+        for entry in held:
+            heapq.heappush(self.heap, entry)
+        return wait
+
+    def done(self, task):
+        self.running.discard(task)
+        if not self.heap and not self.running:
+            self.idle_event.set()
+
+    async def perform(self, action):
+        try:
+            # Discord's own latency for every kind of action, without the time spent queued
+            with metrics.stage_seconds.time(stage = 'discord', action = action.func.__name__):
+                result = await action.func(*action.args, **action.kwargs)
+        except Exception as e:
+            if action.future:
+                if not action.future.cancelled():
+                    action.future.set_exception(e)
+            else:
+                logger.exception("Discord %s badness", action.func.__name__)
+        else:
+            if action.future and not action.future.cancelled():
+                action.future.set_result(result)
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            wait = self.dispatch()
+            if not self.heap and not self.running:
+                self.idle_event.set()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+actions = Outbox()
+metrics.Gauge('lb3_outbox_pending', 'Discord actions waiting to be sent', lambda: [({}, len(actions.heap))])
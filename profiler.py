@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Time-boxed profiling of the running bot, switched on by the profile command,
+# lb3ctl.py profile or SIGUSR1, with the results written out for pstats,
+# snakeviz and the like
+
+import os
+import io
+import re
+import time
+import pstats
+import cProfile
+import logging
+import tempfile
+import functools
+
+import metrics
+
+logger = logging.getLogger('profiler')
+
+DEFAULT_DURATION = 60
+MAX_DURATION = 60 * 60
+# Callbacks that hold the loop for longer than this (seconds) are reported
+DEFAULT_SLOW_CALLBACK = 0.1
+# Functions listed in each section of the report
+REPORT_LIMIT = 40
+
+class SlowCallbackHandler(logging.Handler):
+    """Picks asyncio's debug-mode "Executing ... took ..." warnings out of its logger."""
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        if str(record.msg).startswith('Executing'):
+            self.records.append((record.created, record.getMessage()))
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+null_timer = NullTimer()
+
+class SectionTimer:
+    """Adds the wall time spent in its block, awaits and all, to the profile's totals."""
+    def __init__(self, times, key):
+        self.times = times
+        self.key = key
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.monotonic() - self.start
+        entry = self.times.setdefault(self.key, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        return False
+
+class Profiler:
+    """One profile at a time of everything run on the event loop.
+
+    While it runs, cProfile records CPU time by function, the loop is put in
+    debug mode so asyncio reports callbacks slower than slow_callback, and
+    timed() sections (commands, parse_streams) add up their wall time. When
+    the time's up, or on stop(), the raw profile is dumped to a .prof file
+    and a readable report next to it, and on_done is called with the report's
+    path.
+    """
+    def __init__(self):
+        self.directory = tempfile.gettempdir()
+        self.default_duration = DEFAULT_DURATION
+        self.slow_callback = DEFAULT_SLOW_CALLBACK
+        self.loop = None
+        self.profile = None
+        self.started = None
+        self.ends = None
+        self.timeout = None
+        self.base_path = None
+        self.on_done = []
+        self.times = {}
+        self.slow_handler = None
+        self.saved_debug = None
+        self.last_report = None
+
+    def configure(self, config):
+        profile_conf = config.get('profile', {})
+        self.directory = profile_conf.get('dir', tempfile.gettempdir())
+        self.default_duration = profile_conf.get('duration', DEFAULT_DURATION)
+        self.slow_callback = profile_conf.get('slow-callback', DEFAULT_SLOW_CALLBACK)
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def timed(self, kind, name):
+        """Context manager timing a section of the pipeline, which costs
+        next to nothing when no profile is running."""
+        if self.profile is None:
+            return null_timer
+        return SectionTimer(self.times, (kind, name))
+
+    def start(self, loop, duration = None, on_done = None):
+        """Start profiling for duration seconds, or join the profile already
+        running. Returns the path the report will be written to."""
+        if on_done:
+            self.on_done.append(on_done)
+        if self.profile is not None:
+            return self.base_path + '.txt'
+        duration = min(max(float(duration or self.default_duration), 1), MAX_DURATION)
+        self.loop = loop
+        self.base_path = os.path.join(self.directory, time.strftime('lb3-profile-%Y%m%d-%H%M%S'))
+        self.times = {}
+        self.slow_handler = SlowCallbackHandler()
+        logging.getLogger('asyncio').addHandler(self.slow_handler)
+        self.saved_debug = (loop.get_debug(), loop.slow_callback_duration)
+        loop.slow_callback_duration = self.slow_callback
+        loop.set_debug(True)
+        self.started = time.time()
+        self.ends = self.started + duration
+        self.timeout = loop.call_later(duration, self.stop)
+        metrics.events.inc(event = 'profile_started')
+        logger.warning("Profiling for %.0f seconds into %s.prof", duration, self.base_path)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self.base_path + '.txt'
+
+    def stop(self):
+        """Stop the running profile and write it out. Returns the report's
+        path, or None if nothing was running."""
+        if self.profile is None:
+            return None
+        self.profile.disable()
+        (profile, self.profile) = (self.profile, None)
+        self.timeout.cancel()
+        (debug, slow_callback_duration) = self.saved_debug
+        self.loop.set_debug(debug)
+        self.loop.slow_callback_duration = slow_callback_duration
+        logging.getLogger('asyncio').removeHandler(self.slow_handler)
+        report_path = self.base_path + '.txt'
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            profile.dump_stats(self.base_path + '.prof')
+            with open(report_path, 'w') as outfile:
+                outfile.write(self.report(profile, time.time() - self.started))
+            logger.warning("Profile written to %s", report_path)
+            self.last_report = report_path
+        except:
+            logger.exception("Profile dump badness")
+            report_path = None
+        (on_done, self.on_done) = (self.on_done, [])
+        for func in on_done:
+            try:
+                func(report_path)
+            except:
+                logger.exception("Profile callback badness")
+        return report_path
+
+    def toggle(self, loop):
+        """For SIGUSR1: start a profile, or finish the one running early."""
+        if self.profile is None:
+            self.start(loop)
+        else:
+            self.stop()
+
+    def report(self, profile, elapsed):
+        out = io.StringIO()
+        out.write('Profile of %.1f seconds from %s\n\n' %
+                  (elapsed, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))))
+
+        out.write('Wall time by section (count, total s, mean ms, max ms)\n')
+        for ((kind, name), (count, total, longest)) in sorted(self.times.items(), key = lambda item: -item[1][1]):
+            out.write('  %-10s %-32s %6d %10.3f %10.3f %10.3f\n' %
+                      (kind, name, count, total, 1000 * total / count, 1000 * longest))
+        if not self.times:
+            out.write('  none\n')
+
+        records = self.slow_handler.records
+        out.write('\nSlow callbacks (over %.3fs): %d\n' % (self.slow_callback, len(records)))
+        for (created, text) in records:
+            out.write('  %s %s\n' % (time.strftime('%H:%M:%S', time.localtime(created)), text))
+
+        # Our own modules, where coroutines and commands show up by name
+        here = os.path.dirname(os.path.abspath(__file__))
+        for (title, sort_key, restrictions) in (('CPU time in bot code, by cumulative time', 'cumulative', (re.escape(here), REPORT_LIMIT)),
+                                                ('CPU time overall, by own time', 'tottime', (REPORT_LIMIT,))):
+            out.write('\n%s\n' % title)
+            stats = pstats.Stats(profile, stream = out)
+            stats.sort_stats(sort_key).print_stats(*restrictions)
+        return out.getvalue()
+
+    def status(self):
+        if self.profile is None:
+            return { 'running': False, 'last_report': self.last_report }
+        return { 'running': True, 'ends_in': round(self.ends - time.time(), 1), 'report': self.base_path + '.txt' }
+
+session = Profiler()
+
+def timed(kind):
+    """Decorator timing every call of a coroutine function as a section of any profile running."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with session.timed(kind, func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Long-running Twitch webhook receiver, used in place of the CGI twitch_webhook.py
+# so callbacks go straight into the bot's queue without starting an interpreter
+
+import json
+from urllib.parse import parse_qs
+import logging
+from aiohttp import web
+
+import webhook
+import metrics
+
+# Under bottington so the Input lines reach the bot log
+logger = logging.getLogger('bottington.receiver')
+
+class WebhookReceiver:
+    def __init__(self, config, server_ids, deliver, loop):
+        receiver_conf = config['webhook-receiver']
+        self.host = receiver_conf.get('host', '127.0.0.1')
+        self.port = receiver_conf.get('port', 8080)
+        self.path = receiver_conf.get('path', '/')
+        self.server_ids = set(server_ids)
+        self.secret = config['twitch']['secret']
+        webhook.dedup_window = receiver_conf.get('dedup-window', webhook.dedup_window)
+        self.deliver = deliver
+        self.loop = loop
+        self.app = web.Application(loop = loop)
+        self.app.router.add_route('GET', self.path, self.handle_get)
+        self.app.router.add_route('POST', self.path, self.handle_post)
+        self.handler = None
+        self.server = None
+
+    async def start(self):
+        self.handler = self.app.make_handler()
+        self.server = await self.loop.create_server(self.handler, self.host, self.port)
+        logger.info("Webhook receiver listening on %s:%s%s", self.host, self.port, self.path)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            await self.app.shutdown()
+            await self.handler.shutdown(5.0)
+            await self.app.cleanup()
+            self.server = None
+
+    def server_args(self, request):
+        args = parse_qs(request.query_string)
+        server = args.get('lb3.server', [None])[0]
+        if server not in self.server_ids:
+            logger.error("Callback for server %s, not ours", server)
+            return (None, args)
+        return (server, args)
+
+    async def handle_get(self, request):
+        response = 'OK\n'
+        try:
+            (server, args) = self.server_args(request)
+            if server and ('hub.challenge' in args):
+                (response, message) = webhook.parse_challenge(args)
+                if message:
+                    self.deliver(message)
+        except:
+            logger.exception("Challenge baddness")
+        return web.Response(text = response, content_type = 'text/plain')
+
+    async def handle_post(self, request):
+        metrics.events.inc(event = 'webhook_post')
+        with metrics.stage_seconds.time(stage = 'webhook'):
+            return await self.process_post(request)
+
+    async def process_post(self, request):
+        try:
+            body = await request.text()
+            logger.info("Input: %s", body)
+            (server, args) = self.server_args(request)
+            if server and webhook.signature_matches(self.secret, body, request.headers.get('X-Hub-Signature')):
+                notification_id = request.headers.get('Twitch-Notification-Id')
+                message = webhook.parse_notification(server, args, json.loads(body), notification_id)
+                if message:
+                    self.deliver(message)
+        except:
+            logger.exception("Notification baddness")
+        return web.Response(text = 'OK\n', content_type = 'text/plain')
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# Replays real stream notifications, pulled from the webhook and bot logs,
+# through the go-live pipeline at a chosen rate and burst shape.
+#
+# Uses the stand-ins from benchmark.py. Notification bodies come from the
+# "Input: ..." lines twitch_webhook.py and the receiver log, and the
+# "MQ message: '...'" lines the bot logs (text or JSON log format). Each one
+# is re-signed with the benchmark secret and fired at the CGI script, the
+# in-process receiver or straight into the POSIX MQ (--path mq). Reports
+# callback-to-announcement latency, and how deep the bot's queue and outbox
+# got, to find where a go-live spike backs up.
+
+import sys
+import json
+import queue
+import math
+import time
+import uuid
+import asyncio
+import argparse
+import aiohttp
+
+import benchmark
+
+# Log message prefixes followed by a notification, and whether what follows is
+# the whole MQ message rather than just the callback body
+LOG_MARKERS = (('Input: ', False), ("MQ message: '", True))
+
+def extract_body(line):
+    """The notification body logged on line, or None."""
+    line = line.rstrip('\n')
+    if line.startswith('{'):
+        # JSON log format
+        try:
+            line = json.loads(line).get('message', '')
+        except ValueError:
+            return None
+    for (marker, whole_message) in LOG_MARKERS:
+        pos = line.find(marker)
+        if pos < 0:
+            continue
+        text = line[pos + len(marker):]
+        if whole_message and text.endswith("'"):
+            text = text[:-1]
+        try:
+            logged = json.loads(text)
+        except ValueError:
+            # Not JSON, or cut short by log truncation
+            return None
+        if whole_message:
+            if logged.get('action') != 'stream':
+                return None
+            logged = { 'data': logged.get('data', []) }
+        if isinstance(logged, dict) and isinstance(logged.get('data'), list):
+            return logged
+    return None
+
+def load_bodies(log_files):
+    """Notification bodies from the logs, in order. The same notification is
+    often in both the webhook and bot logs, so repeats are only kept once."""
+    bodies = []
+    seen = set()
+    for log_file in log_files:
+        with open(log_file, 'r', errors = 'replace') as infile:
+            for line in infile:
+                body = extract_body(line)
+                if body is None:
+                    continue
+                key = json.dumps(body, sort_keys = True)
+                if key not in seen:
+                    seen.add(key)
+                    bodies.append(body)
+    return bodies
+
+def schedule(shape, count, rate, burst, interval):
+    """Seconds from the start at which to send each of count notifications."""
+    if shape == 'steady':
+        return [i / rate for i in range(count)]
+    if shape == 'burst':
+        return [0.0] * count
+    if shape == 'spikes':
+        # burst at once every interval, like raids or a scheduled event
+        return [(i // burst) * interval for i in range(count)]
+    # ramp: the rate climbs steadily from nothing to rate
+    duration = 2.0 * count / rate
+    return [duration * math.sqrt(i / count) for i in range(count)]
+
+def live_users(body):
+    return [entry['user_id'] for entry in body['data']
+            if ('user_id' in entry) and (entry.get('type', 'live') == 'live')]
+
+class ReplayPipeline(benchmark.Pipeline):
+    def __init__(self, args, loop, workdir, bottington, server):
+        super().__init__(args, loop, workdir, bottington, server)
+        self.bodies = []
+        self.queue_peak = 0
+        self.outbox_peak = 0
+        self.lag = []
+        self.mq = None
+
+    async def send_mq(self, query, body, notification_id):
+        import ipcqueue.posixmq
+        import ipcqueue.serializers
+        import mqformat
+        user_id = query.rsplit('=', 1)[1]
+        message = { 'action':   'stream',
+                    'args':     { 'lb3.server': [self.server.id], 'lb3.user_id': [user_id] },
+                    'data':     json.loads(body)['data'],
+                    'received': time.time() }
+        if self.mq is None:
+            self.mq = ipcqueue.posixmq.Queue('/bottington_%s' % self.server.id, serializer = ipcqueue.serializers.RawSerializer)
+        for frame in mqformat.encode(message, self.mq.qattr()['max_msgbytes']):
+            while True:
+                try:
+                    self.mq.put(frame, block = False)
+                    break
+                except queue.Full:
+                    # The bot reads the MQ on this loop too, so wait rather than block it
+                    await asyncio.sleep(0.01)
+
+    async def sample(self):
+        import outbox
+        while True:
+            self.queue_peak = max(self.queue_peak, len(self.bottington.event_queue))
+            self.outbox_peak = max(self.outbox_peak, len(outbox.actions.heap))
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        args = self.args
+        send = { 'cgi': self.send_cgi, 'receiver': self.send_receiver, 'mq': self.send_mq }[args.path]
+        self.http = aiohttp.ClientSession(loop = self.loop)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        bodies = [self.bodies[i % len(self.bodies)] for i in range(args.count)]
+        offsets = schedule(args.shape, len(bodies), args.rate, args.burst, args.interval)
+        self.expected = sum(len(live_users(body)) for body in bodies)
+
+        async def fire(body, offset):
+            await asyncio.sleep(offset - (time.perf_counter() - start))
+            # Offline notifications have no user; any will do for the callback URL
+            user_ids = live_users(body) or ['0']
+            query = 'lb3.server=%s&lb3.user_id=%s' % (self.server.id, user_ids[0])
+            async with semaphore:
+                now = time.perf_counter()
+                self.lag.append(now - start - offset)
+                for user_id in live_users(body):
+                    self.sent_at['bench%s' % user_id].append(now)
+                await send(query, json.dumps(body), str(uuid.uuid4()))
+
+        sampler = asyncio.ensure_future(self.sample())
+        start = time.perf_counter()
+        await asyncio.gather(*[fire(body, offset) for (body, offset) in zip(bodies, offsets)])
+        try:
+            await asyncio.wait_for(self.done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print('Timed out with %d of %d announcements' % (len(self.latencies), self.expected))
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        await self.http.close()
+        if self.mq:
+            self.mq.close()
+        benchmark.report('replay %s (%s)' % (args.shape, args.path), self.latencies, elapsed)
+        benchmark.report('send lag', self.lag)
+        print('Peak bot queue: %d messages  Peak outbox: %d actions' % (self.queue_peak, self.outbox_peak))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay logged notifications through Lord Bottington')
+    parser.add_argument('logs', nargs = '+', help = 'twitch-webhook.log and/or bot log files')
+    parser.add_argument('--path', choices = ['cgi', 'receiver', 'mq'], default = 'receiver',
+                        help = 'where to send the notifications')
+    parser.add_argument('--shape', choices = ['steady', 'burst', 'spikes', 'ramp'], default = 'steady')
+    parser.add_argument('--count', type = int, help = 'notifications to send, cycling the logged ones (default all of them once)')
+    parser.add_argument('--rate', type = float, default = 10, help = 'notifications/s for steady, peak for ramp')
+    parser.add_argument('--burst', type = int, default = 50, help = 'notifications in each spike')
+    parser.add_argument('--interval', type = float, default = 10, help = 'seconds between spikes')
+    parser.add_argument('--concurrency', type = int, default = 64, help = 'callbacks in flight at once')
+    parser.add_argument('--helix-delay', type = float, default = 0.05, help = 'simulated Twitch API latency (s)')
+    parser.add_argument('--discord-delay', type = float, default = 0.1, help = 'simulated Discord API latency (s)')
+    parser.add_argument('--timeout', type = float, default = 300)
+    parser.add_argument('--metrics', action = 'store_true', help = 'dump the per-stage metrics after the run')
+    args = parser.parse_args()
+
+    bodies = load_bodies(args.logs)
+    if not bodies:
+        print('No notifications found in %s' % ' '.join(args.logs))
+        return 1
+    args.count = args.count or len(bodies)
+    args.notifications = args.count
+    print('Replaying %d of %d logged notifications' % (args.count, len(bodies)))
+
+    harness = benchmark.Harness(args, ReplayPipeline)
+    harness.pipeline.bodies = bodies
+    try:
+        harness.loop.run_until_complete(harness.pipeline.run())
+        harness.settle()
+        if args.metrics:
+            import metrics
+            print(metrics.render())
+        print('Twitch API requests: %d  Discord calls: %s' % (harness.helix.requests, dict(harness.client.calls)))
+    finally:
+        harness.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import re
+import logging
+
+logger = logging.getLogger('router')
+
+COMMAND_RE = re.compile(r'^lb3_(.+)_command$')
+ALL_COMMAND_RE = re.compile(r'^lb3_(.+)_all_command$')
+
+class CommandRouter:
+    """Command tables built once the bot is ready.
+
+    lb3_<word>_command functions answer in the config channels, and
+    lb3_<word>_all_command functions answer everywhere else. Both tables are
+    keyed by the command word so routing a message is a single dict look-up.
+    """
+    def __init__(self, bot_user_id):
+        self.marker = '<@%s>' % bot_user_id
+        self.config_commands = {}
+        self.all_commands = {}
+
+    def add_commands(self, namespace):
+        """Register every lb3_*_command in a dict of names to functions,
+        e.g. globals() or vars(module)."""
+        for (name, func) in namespace.items():
+            match = COMMAND_RE.match(name)
+            if match and callable(func):
+                logger.info("Found func %s", name)
+                self.config_commands[match.group(1)] = func
+                match = ALL_COMMAND_RE.match(name)
+                if match:
+                    self.all_commands[match.group(1)] = func
+
+    def route(self, content, config_channel):
+        """Returns None if the bot isn't mentioned, otherwise the tuple
+        (command_func, param_text, params), with command_func None if the
+        message doesn't name a known command."""
+        if self.marker not in content:
+            return None
+        command = content.replace(self.marker, '').lstrip()
+        parts = command.split(None, 1)
+        if not parts:
+            return (None, '', [])
+        param_text = parts[1] if len(parts) > 1 else ''
+        table = self.config_commands if config_channel else self.all_commands
+        command_func = table.get(parts[0])
+        if command_func:
+            logger.debug('command=%s func=%s', command, command_func.__name__)
+        return (command_func, param_text, param_text.split())
@@ -4,20 +4,31 @@ import logging
 import asyncio
 import discord
 
+import outbox
+import twitch
+import subscriptions
+
 logger = logging.getLogger('streamers')
 pending_streamers = {}
 
 async def parse_subunsub_confirm(client, confirm_msg, subscribe):
+    server_id = confirm_msg['args']['lb3.server'][0]
     user_id = confirm_msg['args']['lb3.user_id'][0]
-    message = pending_streamers.pop(user_id, None)
+    if subscribe:
+        user = await twitch.get_user(user_id)
+        if user:
+            subscriptions.registry.confirm(server_id, user, subscriptions.lease_expires_at(confirm_msg['args']))
+    else:
+        subscriptions.registry.remove(server_id, user_id)
+    message = pending_streamers.pop((server_id, user_id), None)
     if message:
-        await client.add_reaction(message, '\U0001F5A4')
+        outbox.actions.post(outbox.TIDY, client.add_reaction, message, '\U0001F5A4')
     # TODO Add role and Trello card
 
 async def add_streamer(message, user_ids):
     # Only respond to one message
-    pending_streamers[user_ids[0]] = message
+    pending_streamers[(message.server.id, user_ids[0])] = message
 
 async def remove_streamer(message, user_ids):
     # Only respond to one message
-    pending_streamers[user_ids[0]] = message
+    pending_streamers[(message.server.id, user_ids[0])] = message
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+
+import journal
+
+logger = logging.getLogger('streamstate')
+
+# Default age after which a previous announcement is forgotten rather than deleted
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+class StreamRecord:
+    """Where the last announcement for a streamer went."""
+    __slots__ = ('channel_id', 'message_id', 'announced')
+
+    def __init__(self, channel_id, message_id, announced):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.announced = announced
+
+class MessageRef:
+    """Just enough of a discord.Message for delete_message/edit_message,
+    so a stored announcement can be acted on without fetching it first."""
+    __slots__ = ('id', 'channel')
+
+    def __init__(self, message_id, channel):
+        self.id = message_id
+        self.channel = channel
+
+class StreamState:
+    """Last announcement per Discord server and Twitch user ID.
+
+    Every change is appended to a JSON-lines journal, which is replayed on
+    start-up and compacted once it holds mostly superseded entries.
+    """
+    def __init__(self):
+        self.records = {}
+        self.path = None
+        self.max_age = DEFAULT_MAX_AGE
+        self.journal = None
+
+    def open(self, path, max_age = DEFAULT_MAX_AGE):
+        """Load and compact the journal at path."""
+        self.path = path
+        self.max_age = max_age
+        self.journal = journal.Journal(path, self.snapshot)
+        self.load()
+        self.journal.compact()
+
+    def load(self):
+        for entry in self.journal.entries():
+            key = (entry['s'], entry['u'])
+            if 'm' in entry:
+                self.records[key] = StreamRecord(entry['c'], entry['m'], entry['t'])
+            else:
+                self.records.pop(key, None)
+        logger.info("Loaded %d stream records", len(self.records))
+
+    def snapshot(self):
+        self.evict_stale()
+        return [self.record_entry(key, record) for (key, record) in self.records.items()]
+
+    def record_entry(self, key, record):
+        return { 's': key[0], 'u': key[1], 'c': record.channel_id, 'm': record.message_id, 't': record.announced }
+
+    def append(self, entry):
+        if not self.journal:
+            return
+        try:
+            self.journal.append(entry, len(self.records))
+        except OSError:
+            logger.exception("Stream state write badness")
+
+    def evict_stale(self):
+        oldest = time.time() - self.max_age
+        stale = [key for (key, record) in self.records.items() if record.announced < oldest]
+        for key in stale:
+            del self.records[key]
+        return len(stale)
+
+    def get(self, server_id, user_id):
+        record = self.records.get((server_id, user_id))
+        if record and (record.announced < time.time() - self.max_age):
+            self.remove(server_id, user_id)
+            return None
+        return record
+
+    def set(self, server_id, user_id, channel_id, message_id):
+        key = (server_id, user_id)
+        record = StreamRecord(channel_id, message_id, time.time())
+        self.records[key] = record
+        self.append(self.record_entry(key, record))
+        return record
+
+    def remove(self, server_id, user_id):
+        if self.records.pop((server_id, user_id), None):
+            self.append({ 's': server_id, 'u': user_id })
+
+    def message_ref(self, client, record):
+        """MessageRef for a record, or None if its channel has gone."""
+        channel = client.get_channel(record.channel_id)
+        if channel:
+            return MessageRef(record.message_id, channel)
+        return None
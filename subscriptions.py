@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import collections
+
+import twitch
+import metrics
+
+logger = logging.getLogger('subscriptions')
+
+# Seconds between reconciliations with Twitch's subscription list
+DEFAULT_RECONCILE_INTERVAL = 60 * 60
+
+class Subscription:
+    __slots__ = ('user_id', 'login', 'display_name', 'expires_at')
+
+    def __init__(self, user_id, login, display_name, expires_at):
+        self.user_id = user_id
+        self.login = login
+        self.display_name = display_name
+        self.expires_at = expires_at
+
+    def user(self):
+        """In the form twitch.lookup_users gives, for sub_unsub_user."""
+        return { 'id': self.user_id, 'login': self.login, 'display_name': self.display_name }
+
+class SubscriptionRegistry:
+    """Our webhook subscriptions, by Discord server ID and Twitch user ID.
+
+    Kept up to date from (un)subscribe confirmations, and reconciled with
+    Twitch's own list now and again to catch leases that lapsed or were
+    changed behind our back. Until a server's first reconciliation the
+    registry can't be trusted to be complete, so synced() is False.
+    """
+    def __init__(self):
+        self.servers = {}
+        self.reconciled = set()
+        # Display name lists for "list", by server ID, dropped on any change
+        self.names = {}
+
+    def subs(self, server_id):
+        return self.servers.setdefault(server_id, collections.OrderedDict())
+
+    def synced(self, server_id):
+        return server_id in self.reconciled
+
+    def confirm(self, server_id, user, expires_at):
+        self.subs(server_id)[user['id']] = Subscription(user['id'], user['login'], user['display_name'], expires_at)
+        self.names.pop(server_id, None)
+
+    def remove(self, server_id, user_id):
+        if self.subs(server_id).pop(user_id, None):
+            self.names.pop(server_id, None)
+
+    def users(self, server_id):
+        return [sub.user() for sub in self.subs(server_id).values()]
+
+    def display_names(self, server_id):
+        names = self.names.get(server_id)
+        if names is None:
+            names = ' '.join(sub.display_name for sub in self.subs(server_id).values())
+            self.names[server_id] = names
+        return names
+
+    async def reconcile(self, configs):
+        """Bring the servers in configs (server ID -> config) into line with
+        Twitch, looking up only users we don't already know. Returns the
+        user IDs removed from each server, or None if Twitch couldn't be asked."""
+        all_subs = await twitch.get_all_subs()
+        if all_subs is None:
+            return None
+        current = {}
+        for sub in all_subs:
+            server_id = twitch.sub_server_id(sub)
+            if server_id in configs:
+                current.setdefault(server_id, {})[twitch.sub_user_id(sub)] = twitch.sub_expires_at(sub)
+        removed = {}
+        for (server_id, config) in configs.items():
+            expiries = current.get(server_id, {})
+            subs = self.subs(server_id)
+            removed[server_id] = [user_id for user_id in subs if user_id not in expiries]
+            for user_id in removed[server_id]:
+                self.remove(server_id, user_id)
+            unknown = [('id', user_id) for user_id in expiries if user_id not in subs]
+            if unknown:
+                for user in await twitch.lookup_users(config, unknown) or []:
+                    self.confirm(server_id, user, expiries[user['id']])
+            for (user_id, expires_at) in expiries.items():
+                if user_id in subs:
+                    subs[user_id].expires_at = expires_at
+            self.reconciled.add(server_id)
+            logger.info("%d subscriptions for %s, %d new, %d gone",
+                        len(subs), server_id, len(unknown), len(removed[server_id]))
+        return removed
+
+registry = SubscriptionRegistry()
+metrics.Gauge('lb3_subscriptions', 'Webhook subscriptions by Discord server',
+              lambda: [({ 'server': server_id }, len(subs)) for (server_id, subs) in registry.servers.items()])
+
+def lease_expires_at(args):
+    """When the lease confirmed by a subscribe callback's args runs out."""
+    lease_seconds = int(args['hub.lease_seconds'][0]) if 'hub.lease_seconds' in args else twitch.LEASE_SECONDS
+    return time.time() + lease_seconds
+
+async def list_subs(client, config):
+    server_id = config['discord']['server']
+    if not registry.synced(server_id):
+        return await twitch.list_subs(client, config)
+    names = registry.display_names(server_id)
+    if names:
+        return ("Twitch will tell me about **%s**" % names, None)
+    return ("Sorry, I can't seem to find my notes", None)
+
+async def resub(client, config):
+    server_id = config['discord']['server']
+    if not registry.synced(server_id):
+        return await twitch.resub(client, config)
+    users = registry.users(server_id)
+    if users:
+        return await twitch.sub_unsub_user(config, None, True, users)
+    return ("I appear to have lost my users", None)
@@ -1,22 +1,143 @@
 #!/usr/bin/env python3
 
+import uuid
+import random
+import asyncio
 import logging
+import collections
 import aiohttp
 
+import webclient
+import metrics
+import journal
+
 logger = logging.getLogger('trello')
 
-async def create_card(config, name):
+CARDS_URI = 'https://api.trello.com/1/cards'
+# Cards submitted at once by the spool worker
+SUBMIT_CONCURRENCY = 4
+RETRY_MIN = 1.0
+RETRY_MAX = 300.0
+
+async def create_card(config, name, list_id = None):
+    """POST one card. Returns the HTTP status, or None if Trello couldn't be reached."""
     params = {
         "name": name,
-        "idList": config['trello']['idea-list'],
+        "idList": list_id or config['trello']['idea-list'],
         "key":    config['trello']['key'],
         "token":  config['trello']['token']
         }
 
-    async with aiohttp.post('https://api.trello.com/1/cards', params=params) as r:
-        if r.status == 200:
-            return (None, '\U0001F44D')
-        else:
-            logger.error("Trello fail %d" % r.status)
+    try:
+        r = await webclient.request('POST', CARDS_URI, params=params)
+        if r.status != 200:
+            logger.error("Trello fail %d", r.status)
             logger.error(await r.text())
-        return (None, '\U0001F44E')
+    except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.error("Trello unreachable: %r", e)
+        return None
+    return r.status
+
+class CardSpool:
+    """Cards waiting to go to Trello, kept in a JSON-lines journal so ideas
+    survive Trello being down and the bot restarting.
+
+    Each card is journalled when queued and again when Trello accepts it; the
+    worker submits whatever is pending, backing off while Trello is failing.
+    """
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.config = None
+        self.path = None
+        self.journal = None
+        self.wakeup = None
+        self.retry_delay = RETRY_MIN
+
+    def open(self, config):
+        self.config = config
+        self.path = config['trello'].get('spool')
+        if self.path:
+            self.journal = journal.Journal(self.path, self.snapshot, fsync = True)
+            self.load()
+            self.journal.compact()
+
+    def load(self):
+        for entry in self.journal.entries():
+            if 'n' in entry:
+                self.pending[entry['i']] = (entry['n'], entry.get('l'))
+            else:
+                self.pending.pop(entry['i'], None)
+        if self.pending:
+            logger.info("%d Trello cards still to send", len(self.pending))
+
+    def snapshot(self):
+        return [{ 'i': card_id, 'n': name, 'l': list_id } for (card_id, (name, list_id)) in self.pending.items()]
+
+    def append(self, entry):
+        if not self.journal:
+            return
+        try:
+            self.journal.append(entry, len(self.pending))
+        except OSError:
+            logger.exception("Trello spool write badness")
+
+    def add(self, name, list_id = None):
+        card_id = uuid.uuid4().hex
+        self.pending[card_id] = (name, list_id)
+        self.append({ 'i': card_id, 'n': name, 'l': list_id })
+        if self.wakeup:
+            self.wakeup.set()
+        return card_id
+
+    def done(self, card_id):
+        if self.pending.pop(card_id, None):
+            self.append({ 'i': card_id })
+
+    async def submit(self, card_id, name, list_id):
+        """True if the card is finished with, sent or refused outright."""
+        status = await create_card(self.config, name, list_id)
+        if status == 200:
+            metrics.events.inc(event = 'trello_card')
+            return True
+        if status in (400, 404):
+            # Won't go however often it's tried, so don't block the spool with it
+            logger.error("Trello refused card, dropping: '%s'", name)
+            metrics.events.inc(event = 'trello_refused')
+            return True
+        return False
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            batch = list(self.pending.items())[:SUBMIT_CONCURRENCY]
+            if not batch:
+                await self.wakeup.wait()
+                continue
+            try:
+                results = await asyncio.gather(*[self.submit(card_id, name, list_id)
+                                                 for (card_id, (name, list_id)) in batch])
+                for ((card_id, card), sent) in zip(batch, results):
+                    if sent:
+                        self.done(card_id)
+            except asyncio.CancelledError:
+                raise
+            except:
+                # Keep the worker going; the cards are still in the spool
+                logger.exception("Trello spool badness")
+                results = [False]
+            if all(results):
+                self.retry_delay = RETRY_MIN
+            else:
+                # Trello's down or rate limiting us; try again later, backing off
+                delay = random.uniform(self.retry_delay / 2, self.retry_delay)
+                logger.warning("Trello cards pending, retrying in %.0fs", delay)
+                self.retry_delay = min(self.retry_delay * 2, RETRY_MAX)
+                await asyncio.sleep(delay)
+
+spool = CardSpool()
+metrics.Gauge('lb3_trello_pending', 'Trello cards waiting to be sent', lambda: [({}, len(spool.pending))])
+
+def queue_card(config, name):
+    spool.add(name, config['trello']['idea-list'])
+    return (None, '\U0001F44D')
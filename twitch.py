@@ -3,66 +3,188 @@
 import os
 import sys
 import json
+import time
+import asyncio
+import collections
+import urllib.parse
 import dateutil.parser
 import datetime
 import pytz
 import logging
-import aiohttp
 import discord
 
+import webclient
+import streamstate
+import metrics
+import outbox
+import guilds
+import profiler
+
 logger = logging.getLogger('twitch')
-stream_state = {}
+stream_state = streamstate.StreamState()
+
+class TtlCache:
+    """Size-bounded LRU cache where every entry expires after a time-to-live.
+
+    Look-ups Twitch answered with nothing are stored as None with their own,
+    shorter, TTL so a missing user or game doesn't cost a Twitch round trip
+    on every notification. Errors raised by fetch_func aren't cached.
+    """
+    def __init__(self, name, max_size, ttl, negative_ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry:
+            (expires, value) = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return (True, value)
+            del self.entries[key]
+        self.misses += 1
+        return (False, None)
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    async def fetch(self, key, fetch_func):
+        (found, value) = self.get(key)
+        if found:
+            return value
+        # Share a single request between callers missing on the same key
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.ensure_future(fetch_func())
+        self.pending[key] = future
+        try:
+            value = await asyncio.shield(future)
+            self.put(key, value)
+            return value
+        finally:
+            self.pending.pop(key, None)
+
+    def stats(self):
+        return { 'name':   self.name,
+                 'size':   len(self.entries),
+                 'hits':   self.hits,
+                 'misses': self.misses }
+
+# Helix accepts at most this many id/login parameters per request
+HELIX_MAX_PARAMS = 100
+# Number of chunked Helix requests allowed in flight at once
+HELIX_CONCURRENCY = 8
+
+def chunk_list(items, size = HELIX_MAX_PARAMS):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+async def gather_chunks(chunk_func, items):
+    """Split items into Helix-sized chunks, run chunk_func on each concurrently
+    (limited to HELIX_CONCURRENCY at a time) and merge the resulting lists in order."""
+    semaphore = asyncio.Semaphore(HELIX_CONCURRENCY)
 
-async def twitch_request(client_id, endpoint, in_id):
+    async def run_chunk(chunk):
+        async with semaphore:
+            return await chunk_func(chunk)
+
+    results = await asyncio.gather(*[run_chunk(chunk) for chunk in chunk_list(items)])
+    merged = []
+    for result in results:
+        merged.extend(result)
+    return merged
+
+user_cache = TtlCache('users', 1024, 60 * 60, 60)
+game_cache = TtlCache('games', 1024, 24 * 60 * 60, 5 * 60)
+
+def cache_stats():
+    return [ user_cache.stats(), game_cache.stats() ]
+
+metrics.Gauge('lb3_twitch_cache_entries', 'Entries in the Twitch user/game caches',
+              lambda: [({ 'cache': cache.name }, len(cache.entries)) for cache in (user_cache, game_cache)])
+metrics.CounterFunc('lb3_twitch_cache_hits_total', 'Twitch user/game cache hits',
+                    lambda: [({ 'cache': cache.name }, cache.hits) for cache in (user_cache, game_cache)])
+metrics.CounterFunc('lb3_twitch_cache_misses_total', 'Twitch user/game cache misses',
+                    lambda: [({ 'cache': cache.name }, cache.misses) for cache in (user_cache, game_cache)])
+
+class TwitchError(Exception):
+    """Twitch couldn't be asked, as opposed to having nothing to tell us."""
+
+async def twitch_request(endpoint, in_id):
+    """The entry for in_id, or None if Twitch has no such thing. Raises
+    TwitchError if Twitch can't be reached or doesn't answer properly, so
+    that isn't cached as a miss."""
     params = { 'id': in_id }
-    headers = { 'Client-ID': client_id }
     try:
-        async with aiohttp.get('https://api.twitch.tv/helix/%s' % endpoint, headers=headers, params=params) as r:
-            if r.status == 200:
-                js = await r.json()
-                return js['data'][0]
-            else:
-                logger.error('Twitch HTTP badness: %s', r.status)
-                logger.error(await r.text())
+        with metrics.stage_seconds.time(stage = 'twitch_%s' % endpoint):
+            r = await webclient.twitch('GET', 'helix/%s' % endpoint, params=params)
+        if r.status == 200:
+            js = await r.json()
+            data = js['data']
+            return data[0] if data else None
+        logger.error('Twitch HTTP badness: %s', r.status)
+        logger.error(await r.text())
+    except asyncio.CancelledError:
+        raise
     except:
         logger.error('Twitch baddness')
-    return None
+    raise TwitchError(endpoint)
 
-async def get_user(client_id, user_id):
-    return await twitch_request(client_id, 'users', user_id)
+async def cached_request(cache, endpoint, in_id):
+    try:
+        return await cache.fetch(in_id, lambda: twitch_request(endpoint, in_id))
+    except TwitchError:
+        return None
 
-async def get_game_title(client_id, game_id, user_id):
-    game = await twitch_request(client_id, 'games', game_id)
+async def get_user(user_id):
+    return await cached_request(user_cache, 'users', user_id)
+
+async def get_game_title(game_id, user_id):
+    game = None
+    if game_id:
+        game = await cached_request(game_cache, 'games', game_id)
     if game:
         return game['name']
     else:
-        headers = { 'Client-ID': client_id,
-                    'Accept':    'application/vnd.twitchtv.v5+json' }
+        headers = { 'Accept': 'application/vnd.twitchtv.v5+json' }
         try:
-            async with aiohttp.get('https://api.twitch.tv/kraken/streams/%s' % user_id, headers=headers) as r:
-                if r.status == 200:
-                    js = await r.json()
-                    game_name = ['stream']['game']
-                    if game_name == "":
-                        game_name = 'Playing some videogames'
-                    return game_name
-                else:
-                    logger.error('Twitch Kraken HTTP badness: %s', r.status)
-                    logger.error(await r.text())
+            r = await webclient.twitch('GET', 'kraken/streams/%s' % user_id, headers=headers)
+            if r.status == 200:
+                js = await r.json()
+                game_name = ['stream']['game']
+                if game_name == "":
+                    game_name = 'Playing some videogames'
+                return game_name
+            else:
+                logger.error('Twitch Kraken HTTP badness: %s', r.status)
+                logger.error(await r.text())
         except:
             logger.error('Twitch Kraken baddness')
         return 'Playing some videogames'
 
 async def lookup_users(config, user_list):
-    headers = { 'Client-ID': config['twitch']['client-id'],
-                'Content-Type': 'application/json' }
-    async with aiohttp.get('https://api.twitch.tv/helix/users', headers=headers, params=user_list) as r:
-        if r.status == 200:
-            user_json = await r.json()
-            return user_json['data']
-        else:
-            logger.error("Username look-up fail %d" % r.status)
-            logger.error(await r.text())
+    return await gather_chunks(lambda chunk: lookup_users_chunk(config, chunk), list(user_list))
+
+async def lookup_users_chunk(config, user_list):
+    r = await webclient.twitch('GET', 'helix/users', params=user_list)
+    if r.status == 200:
+        user_json = await r.json()
+        for user in user_json['data']:
+            user_cache.put(user['id'], user)
+        return user_json['data']
+    else:
+        logger.error("Username look-up fail %d", r.status)
+        logger.error(await r.text())
     return []
 
 def ibzytime(hour, minute):
@@ -76,108 +198,238 @@ def ibzytime(hour, minute):
         negative = True
     return '%s%02d:%02d EIT' % ('-' if negative else '+', (hm / 60), (hm % 60))
 
-async def parse_streams(client, config, server, stream_data):
+async def lookup_stream(live_data):
+    user_id = live_data['user_id']
+    return await asyncio.gather(get_user(user_id), get_game_title(live_data.get('game_id'), user_id))
+
+# Seconds after an announcement during which further notifications for the
+# same streamer edit it rather than sending a new one
+DEFAULT_COALESCE_WINDOW = 120
+
+async def edit_announcement(client, last_stream, embed):
+    """Update a previous announcement in place, returning False if it can't be."""
+    try:
+        last_message = stream_state.message_ref(client, last_stream)
+        if last_message:
+            with metrics.stage_seconds.time(stage = 'discord_edit'):
+                await outbox.actions.call(outbox.ANNOUNCE, client.edit_message, last_message, embed = embed)
+            return True
+    except:
+        logger.exception('Edit failed')
+    return False
+
+async def announce_stream(client, config, server, live_data, user, game_title, coalesce_window, max_age = 0):
+    """Announce one stream, or edit its recent announcement, unless it
+    started more than max_age seconds ago (0 for no limit). Returns the
+    streamer's display name if it went out."""
+    start_time = dateutil.parser.parse(live_data['started_at'])
+    ourtz = pytz.timezone('Europe/London')
+    time_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    start_time_local = start_time.astimezone(ourtz)
+    time_diff = time_now - start_time
+    if max_age and (time_diff.total_seconds() > max_age):
+        # Waited too long behind the rest of the batch to be worth announcing
+        logger.warning("Not announcing %s, started %s ago", live_data['user_id'], time_diff)
+        metrics.events.inc(event = 'event_dropped', reason = 'stale')
+        return None
+    logger.info("Started %d:%02d Delay %s", start_time_local.hour, start_time_local.minute, time_diff)
+    user_id = live_data['user_id']
+    last_stream = stream_state.get(server.id, user_id)
+
+    user_url = "https://twitch.tv/%s" % user['login']
+    embed = discord.Embed(title = user_url, url = user_url, color = 2207743)
+    embed.set_author(name = "I say, %s has gone live!" % user['display_name'], url = user_url) 
+    embed.set_thumbnail(url = user['profile_image_url'])  
+    embed.add_field(name = game_title, value = live_data.get('title') or 'No title', inline = False)
+    if user['login'] == 'evenibzy':
+        embed.set_footer(text = ("Stream started %s" % ibzytime(start_time_local.hour, start_time_local.minute)))
+    else:
+        embed.set_footer(text = ("Stream started %d:%02d" % (start_time_local.hour, start_time_local.minute)))
+
+    channels = config['discord']['channels']
+    channel_name = channels['_default_']
+    delete = True
+    if user['login'] in channels:
+        channel_name = channels[user['login']]
+        delete = False
+    logger.debug("channel_name=%s", channel_name)
+    channel = guilds.get_channel(server, channel_name)
+    # Twitch can send several notifications for one go-live, so update a recent announcement instead
+    if last_stream and (time.time() - last_stream.announced < coalesce_window):
+        if await edit_announcement(client, last_stream, embed):
+            metrics.events.inc(event = 'coalesced')
+            logger.debug('Edited %s:%s', user['login'], last_stream.message_id)
+            return user['display_name']
+    try:
+        with metrics.stage_seconds.time(stage = 'discord_send'):
+            new_message = await outbox.actions.call(outbox.ANNOUNCE, client.send_message, channel, embed = embed)
+        metrics.events.inc(event = 'announcement')
+        stream_state.set(server.id, user_id, new_message.channel.id, new_message.id)
+        logger.debug('Sent %s:%s', user['login'], new_message.id)
+        if last_stream and delete:
+            logger.debug('Deleting %s:%s', user['login'], last_stream.message_id)
+            last_message = stream_state.message_ref(client, last_stream)
+            if last_message:
+                # Tidying up can wait until the rest of the announcements are out
+                outbox.actions.post(outbox.TIDY, client.delete_message, last_message)
+        elif not delete:
+            logger.debug('No delete on this stream')
+        else:
+            logger.debug('No prior stream to delete')
+        return user['display_name']
+    except:
+        logger.exception('Discord badness')
+        logger.error("channel_name=%s", channel_name)
+        logger.error("embed=%s", embed.to_dict())
+    return None
+
+@profiler.timed('coroutine')
+async def parse_streams(client, config, server, stream_data, coalesce = True, max_age = 0):
     users_announced = []
+    coalesce_window = config['discord'].get('coalesce-window', DEFAULT_COALESCE_WINDOW) if coalesce else 0
     try:
-        client_id = config['twitch']['client-id']
+        # Only the latest notification for each streamer in a batch is used
+        live_streams = collections.OrderedDict()
         for live_data in stream_data['data']:
             logger.debug(live_data)
             if ('type' in live_data) and (live_data['type'] != 'live'):
                 logger.info('Ignoring VOD')
                 continue
+            if not live_data.get('user_id'):
+                logger.error("Stream with no user ID: %s", live_data)
+                continue
             # Was seeing some issues where the first notification had no language set, and then the second was sent
             # with a different ID.  Looks like Twitch may have fixed this, so commenting to prevent notifications
             # being ignored.
             #if ('language' in live_data) and (live_data['language'] == ''):
             #   logger.info("Ignoring live data with no language set")
             #   continue
-            start_time = dateutil.parser.parse(live_data['started_at'])
-            ourtz = pytz.timezone('Europe/London')
-            time_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-            start_time_local = start_time.astimezone(ourtz)
-            time_diff = time_now - start_time
-            logger.info("Started %d:%02d Delay %s" % (start_time_local.hour, start_time_local.minute, time_diff))
-            user_id = live_data['user_id']
-            user = await get_user(client_id, user_id)
-            last_stream = None
-            if user_id in stream_state:
-                last_stream = stream_state[user_id]
-
-            game_title = await get_game_title(client_id, live_data['game_id'], user_id)
-            user_url = "https://twitch.tv/%s" % user['login']
-            embed = discord.Embed(title = user_url, url = user_url, color = 2207743)
-            embed.set_author(name = "I say, %s has gone live!" % user['display_name'], url = user_url) 
-            embed.set_thumbnail(url = user['profile_image_url'])  
-            embed.add_field(name = game_title, value = live_data['title'], inline = False)
-            if user['login'] == 'evenibzy':
-                embed.set_footer(text = ("Stream started %s" % ibzytime(start_time_local.hour, start_time_local.minute)))
-            else:
-                embed.set_footer(text = ("Stream started %d:%02d" % (start_time_local.hour, start_time_local.minute)))
-
-            channels = config['discord']['channels']
-            channel_name = channels['_default_']
-            delete = True
-            if user['login'] in channels:
-                channel_name = channels[user['login']]
-                delete = False
-            logger.debug("channel_name=%s" % channel_name)
-            channel = discord.utils.get(server.channels, name = channel_name)
-            try:
-                new_stream = {}
-                new_stream['message'] = await client.send_message(channel, embed = embed)
-                stream_state[user_id] = new_stream
-                users_announced.append(user['display_name'])
-                logger.debug('Sent %s:%s' % (user['login'], new_stream['message'].id))
-                if last_stream and delete:
-                    logger.debug('Deleting %s:%s' % (user['login'], last_stream['message'].id))
-                    try:
-                        await client.delete_message(last_stream['message'])
-                    except:
-                        logger.exception('Delete failed')
-                elif not delete:
-                    logger.debug('No delete on this stream')
-                else:
-                    logger.debug('No prior stream to delete')
-            except:
-                logger.exception('Discord badness')
-                logger.error("channel_name=%s" % channel_name)
-                logger.error("embed=%s" % embed.to_dict())
+            live_streams[live_data['user_id']] = live_data
+        live_streams = list(live_streams.values())
+
+        # Look up the users and games for the whole batch at once; announcements still go out in order
+        with metrics.stage_seconds.time(stage = 'twitch_lookups'):
+            lookups = await asyncio.gather(*[lookup_stream(live_data) for live_data in live_streams], return_exceptions = True)
     except:
         logger.exception('Stream badness')
+        return users_announced
+    # Each stream is announced on its own, so one bad one doesn't lose the rest of the batch
+    for (live_data, lookup) in zip(live_streams, lookups):
+        if isinstance(lookup, Exception):
+            logger.error("Look-up for %s failed: %r", live_data['user_id'], lookup)
+            continue
+        (user, game_title) = lookup
+        if not user:
+            logger.error("No user %s, not announcing", live_data['user_id'])
+            continue
+        try:
+            display_name = await announce_stream(client, config, server, live_data, user, game_title, coalesce_window, max_age)
+            if display_name:
+                users_announced.append(display_name)
+        except:
+            logger.exception('Stream badness')
     return users_announced
 
+class HelixRateLimit:
+    """Follows the Ratelimit-Remaining/Ratelimit-Reset headers Twitch returns,
+    holding requests back until the bucket refills once it has been used up."""
+    def __init__(self):
+        self.remaining = None
+        self.reset = 0
+
+    def update(self, headers):
+        try:
+            if 'Ratelimit-Remaining' in headers:
+                self.remaining = int(headers['Ratelimit-Remaining'])
+            if 'Ratelimit-Reset' in headers:
+                self.reset = int(headers['Ratelimit-Reset'])
+        except ValueError:
+            logger.warning('Odd rate limit headers: %s', dict(headers))
+
+    def reset_delay(self):
+        return max(0, self.reset - time.time())
+
+    async def acquire(self):
+        while (self.remaining is not None) and (self.remaining <= 0):
+            delay = self.reset_delay()
+            if delay <= 0:
+                self.remaining = None
+                break
+            logger.info('Rate limited, waiting %.1fs', delay)
+            await asyncio.sleep(delay)
+        if self.remaining is not None:
+            self.remaining -= 1
+
+helix_rate_limit = HelixRateLimit()
+# Number of hub requests allowed in flight at once
+HUB_CONCURRENCY = 8
+# Attempts per hub request before giving up on that user
+HUB_ATTEMPTS = 4
+HUB_BACKOFF = 1.0
+HUB_HEADERS = { 'Content-Type': 'application/json' }
+LEASE_SECONDS = 864000
+
+async def post_hub(sub_data):
+    """POST one (un)subscription to the hub, retrying 429s, 5xx and connection
+    failures with exponential backoff. Returns the final HTTP status or None."""
+    status = None
+    for attempt in range(HUB_ATTEMPTS):
+        await helix_rate_limit.acquire()
+        retry_delay = HUB_BACKOFF * (2 ** attempt)
+        try:
+            r = await webclient.twitch('POST', 'helix/webhooks/hub', headers=HUB_HEADERS, data=json.dumps(sub_data))
+            helix_rate_limit.update(r.headers)
+            status = r.status
+            if status == 202:
+                return status
+            logger.error('Went wrong %d', status)
+            logger.error(await r.text())
+            if status == 429:
+                helix_rate_limit.remaining = 0
+                retry_delay = max(retry_delay, helix_rate_limit.reset_delay())
+            elif status < 500:
+                return status
+        except:
+            logger.exception('Hub request baddness')
+        if attempt + 1 < HUB_ATTEMPTS:
+            await asyncio.sleep(retry_delay)
+    return status
+
 async def sub_unsub_user(config, user_logins, subscribe, users = None):
-    headers = { 'Client-ID': config['twitch']['client-id'],
-                'Content-Type': 'application/json' }
-
-    # Post data for subscription request
-    sub_data = { "hub.mode":          "subscribe" if subscribe else "unsubscribe",
-                 "hub.lease_seconds": 864000,
-                 "hub.secret":        config['twitch']['secret']
-               }
     if not users:
         users = await lookup_users(config, list(map(lambda u: ('login', u), user_logins)))
-    user_names = ''
-    user_ids = []
+    semaphore = asyncio.Semaphore(HUB_CONCURRENCY)
+
     # Send a (un)subcription request for each username
-    for user in users:
-        logger.info('%s: %s' % (user['display_name'], user['id']))
-        sub_data['hub.callback'] = "%s?lb3.server=%s&lb3.user_id=%s" % (config['twitch']['webhook_uri'], config['discord']['server'], user['id'])
-        sub_data['hub.topic'] = "https://api.twitch.tv/helix/streams?user_id=%s" % user['id']
-        # Send a (un)subcription request for each username
-        async with aiohttp.post('https://api.twitch.tv/helix/webhooks/hub', headers=headers, data=json.dumps(sub_data)) as r:
-            if r.status== 202:
-                logger.info('%s OK' % sub_data['hub.topic'])
-                user_names += ' %s' % user['display_name']
-                user_ids.append(user['id'])
-            else:
-                logger.error('Went wrong %d' % r.status)
-                logger.error(await r.text())
+    async def sub_unsub_one(user):
+        logger.info('%s: %s', user['display_name'], user['id'])
+        # Post data for subscription request
+        sub_data = { "hub.mode":          "subscribe" if subscribe else "unsubscribe",
+                     "hub.lease_seconds": LEASE_SECONDS,
+                     "hub.secret":        config['twitch']['secret'],
+                     "hub.callback":      "%s?lb3.server=%s&lb3.user_id=%s" % (config['twitch']['webhook_uri'], config['discord']['server'], user['id']),
+                     "hub.topic":         "https://api.twitch.tv/helix/streams?user_id=%s" % user['id']
+                   }
+        async with semaphore:
+            status = await post_hub(sub_data)
+        if status == 202:
+            logger.info('%s OK', sub_data['hub.topic'])
+        return (user, status)
+
+    results = await asyncio.gather(*[sub_unsub_one(user) for user in users])
+    user_names = ''.join(' %s' % user['display_name'] for (user, status) in results if status == 202)
+    user_ids = [user['id'] for (user, status) in results if status == 202]
+    failed_names = ''.join(' %s' % user['display_name'] for (user, status) in results if status != 202)
     if len(user_ids) > 0:
         if subscribe:
-            return ("Right-ho, I've asked those lovely chaps at Twitch to tell me when**%s** goes live" % user_names, user_ids)
+            response = "Right-ho, I've asked those lovely chaps at Twitch to tell me when**%s** goes live" % user_names
         else:
-            return ("Right-ho, I've asked those lovely chaps at Twitch stop telling me about**%s**" % user_names, user_ids)
+            response = "Right-ho, I've asked those lovely chaps at Twitch stop telling me about**%s**" % user_names
+        if failed_names:
+            response += ", but they wouldn't hear of**%s**" % failed_names
+        return (response, user_ids)
+    if failed_names:
+        return ("Frightfully sorry, Twitch wouldn't listen about**%s**" % failed_names, None)
     return ("Sorry, old-bean. I couldn't find anyone.", None)
 
 async def sub_user(config, user_logins):
@@ -189,43 +441,73 @@ async def unsub_user(config, user_logins):
 async def announce_user(client, config, server, user_logins):
     response = "Nothing doing, I'm afraid"
     logger.info(user_logins)
-    headers = { 'Client-ID': config['twitch']['client-id'],
-                'Content-Type': 'application/json' }
     params = list(map(lambda u: ('user_login', u), user_logins))
 
-    async with aiohttp.get('https://api.twitch.tv/helix/streams', headers=headers, params=params) as r:
+    async def get_streams(chunk):
+        # Default page size is 20, so ask for enough to cover the whole chunk
+        chunk_params = chunk + [('first', str(len(chunk)))]
+        r = await webclient.twitch('GET', 'helix/streams', params=chunk_params)
         if r.status == 200:
             streams_json = await r.json()
-            users = await parse_streams(client, config, server, streams_json)
-            if len(users) > 0:
-                response = "Announced %s" % (' '.join(users))
+            return streams_json['data']
+        else:
+            logger.error('Twitch streams HTTP badness: %s', r.status)
+            logger.error(await r.text())
+        return []
+
+    streams = await gather_chunks(get_streams, params)
+    if len(streams) > 0:
+        users = await parse_streams(client, config, server, { 'data': streams }, coalesce = False)
+        if len(users) > 0:
+            response = "Announced %s" % (' '.join(users))
     return (response, None)
 
-async def get_subs(config):
-    headers = { 'Authorization': 'Bearer %s' % config['twitch']['app-token'] }
+async def get_all_subs():
+    """Every webhook subscription the app has, following every page of
+    results, or None if Twitch couldn't give us all of them."""
     get_more = True
-    user_ids = []
+    all_subs = []
     params = None
     while get_more:
         get_more = False
-        async with aiohttp.get('https://api.twitch.tv/helix/webhooks/subscriptions', headers=headers, params=params) as r:
-            if r.status == 200:
-                subs = await r.json()
-                logger.debug("All subs: %s" % subs)
-                server_str = 'lb3.server=%s' % config['discord']['server']
-                server_subs = list(filter(lambda sub: server_str in sub['callback'], subs['data']))
-                logger.debug("Server subs: %s" % server_subs)
-                new_ids = list(map(lambda sub: ('id', sub['topic'].split('=')[1]), server_subs))
-                logger.debug("User IDs: %s" % new_ids)
-                user_ids.extend(new_ids)
-                if ('pagination' in subs) and ('cursor' in subs['pagination']):
-                    params = [('after', subs['pagination']['cursor'])]
-                    get_more = True
+        r = await webclient.twitch('GET', 'helix/webhooks/subscriptions', bearer=True, params=params)
+        if r.status == 200:
+            subs = await r.json()
+            logger.debug("All subs: %s", subs)
+            all_subs.extend(subs['data'])
+            if ('pagination' in subs) and ('cursor' in subs['pagination']):
+                params = [('after', subs['pagination']['cursor'])]
+                get_more = True
 
-            else:
-                logger.error('Twitch webhook HTTP badness: %s', r.status)
-                logger.error(await r.text())
+        else:
+            logger.error('Twitch webhook HTTP badness: %s', r.status)
+            logger.error(await r.text())
+            return None
+    return all_subs
 
+async def get_server_subs(config):
+    """This server's webhook subscriptions, or None if they couldn't be listed."""
+    all_subs = await get_all_subs()
+    if all_subs is None:
+        return None
+    server_subs = [sub for sub in all_subs if sub_server_id(sub) == config['discord']['server']]
+    logger.debug("Server subs: %s", server_subs)
+    return server_subs
+
+def sub_server_id(sub):
+    query = urllib.parse.urlsplit(sub['callback']).query
+    return urllib.parse.parse_qs(query).get('lb3.server', [None])[0]
+
+def sub_user_id(sub):
+    return sub['topic'].split('=')[1]
+
+def sub_expires_at(sub):
+    return dateutil.parser.parse(sub['expires_at']).timestamp()
+
+async def get_subs(config):
+    server_subs = await get_server_subs(config) or []
+    user_ids = list(map(lambda sub: ('id', sub_user_id(sub)), server_subs))
+    logger.debug("User IDs: %s", user_ids)
     if len(user_ids) > 0:
         return await lookup_users(config, user_ids)
     return None
@@ -233,7 +515,7 @@ async def get_subs(config):
 async def list_subs(client, config):
     users = await get_subs(config)
     if users:
-        logger.debug("Users: %s" % users)
+        logger.debug("Users: %s", users)
         user_names = list(map(lambda user: user['display_name'], users))
         return ("Twitch will tell me about **%s**" % ' '.join(user_names), None)
     else:
@@ -242,7 +524,7 @@ async def list_subs(client, config):
 async def resub(client, config):
     users = await get_subs(config)
     if users:
-        logger.debug("Users: %s" % users)
+        logger.debug("Users: %s", users)
         return await sub_unsub_user(config, None, True, users)
     else:
         return ("I appear to have lost my users", None)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import asyncio
+import inspect
+import logging
+import aiohttp
+
+logger = logging.getLogger('webclient')
+
+# One pooled session shared by every outbound call, opened and closed by bottington
+session = None
+request_timeout = 10
+twitch_headers = {}
+twitch_uri = 'https://api.twitch.tv/'
+twitch_bearer = None
+
+def open_session(config, loop):
+    """Create the shared keep-alive session. Settings come from the optional
+    "http" config section: "pool-size" (connections per host), "keepalive"
+    and "timeout" (seconds)."""
+    global session
+    global request_timeout
+    global twitch_headers
+    global twitch_bearer
+    global twitch_uri
+    http_conf = config.get('http', {})
+    request_timeout = http_conf.get('timeout', 10)
+    twitch_headers = { 'Client-ID': config['twitch']['client-id'] }
+    twitch_bearer = 'Bearer %s' % config['twitch']['app-token']
+    # Only changed to point at a local stand-in, e.g. by benchmark.py
+    twitch_uri = config['twitch'].get('api-uri', twitch_uri)
+    connector = aiohttp.TCPConnector(limit = http_conf.get('pool-size', 20),
+                                     keepalive_timeout = http_conf.get('keepalive', 60),
+                                     loop = loop)
+    session = aiohttp.ClientSession(connector = connector, loop = loop)
+    logger.info("HTTP session open, timeout %ss", request_timeout)
+    return session
+
+async def close_session():
+    global session
+    if session:
+        logger.info("Closing HTTP session")
+        closing = session.close()
+        # close() only became awaitable in later aiohttp versions
+        if inspect.isawaitable(closing):
+            await closing
+        session = None
+
+async def fetch(method, url, **kwargs):
+    async with session.request(method, url, **kwargs) as r:
+        # Read the body so the connection goes straight back to the pool;
+        # text() and json() still work on the response afterwards
+        await r.read()
+        return r
+
+async def request(method, url, **kwargs):
+    """Make a request on the shared session, raising asyncio.TimeoutError if
+    the whole request, body included, takes longer than the configured timeout."""
+    return await asyncio.wait_for(fetch(method, url, **kwargs), request_timeout)
+
+async def twitch(method, endpoint, headers = None, bearer = False, **kwargs):
+    """Request a Twitch API endpoint (e.g. 'helix/users') with the default
+    Client-ID header, and the app token as Bearer authorization if asked."""
+    all_headers = dict(twitch_headers)
+    if bearer:
+        all_headers['Authorization'] = twitch_bearer
+    if headers:
+        all_headers.update(headers)
+    return await request(method, '%s%s' % (twitch_uri, endpoint), headers = all_headers, **kwargs)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Twitch webhook callback handling shared by the CGI script (twitch_webhook.py)
+# and the in-process receiver (receiver.py)
+
+import os
+from urllib.parse import parse_qsl
+import hashlib
+import hmac
+import logging
+import sqlite3
+import time
+
+import metrics
+
+logger = logging.getLogger('webhook')
+
+# Where the CGI script logs and the dedup store lives
+log_dir = os.getenv("BOTTINGTON_LOG_DIR", '/var/log/lb3')
+
+# Seconds a notification ID is remembered for duplicate detection
+dedup_window = 60 * 60
+dedup_stores = {}
+
+class DedupStore:
+    """Notification IDs seen within the dedup window, kept in SQLite in WAL mode
+    so the CGI script and the in-process receiver can share it safely."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout = 10, isolation_level = None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS notifications '
+                        '(id TEXT PRIMARY KEY, seen REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS notifications_seen ON notifications (seen)')
+        # Running totals, which unlike the hits above outlive the dedup window
+        self.db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute("INSERT OR IGNORE INTO counters (name) VALUES ('duplicates')")
+
+    def is_duplicate(self, new_id, window):
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('DELETE FROM notifications WHERE seen < ?', (now - window,))
+            cursor = self.db.execute('INSERT OR IGNORE INTO notifications (id, seen) VALUES (?, ?)', (new_id, now))
+            duplicate = cursor.rowcount == 0
+            if duplicate:
+                self.db.execute('UPDATE notifications SET hits = hits + 1 WHERE id = ?', (new_id,))
+                self.db.execute("UPDATE counters SET value = value + 1 WHERE name = 'duplicates'")
+            self.db.execute('COMMIT')
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        return duplicate
+
+    def stats(self):
+        (entries, hits) = self.db.execute('SELECT COUNT(*), IFNULL(SUM(hits), 0) FROM notifications').fetchone()
+        (total,) = self.db.execute("SELECT value FROM counters WHERE name = 'duplicates'").fetchone()
+        return { 'entries': entries, 'duplicate_hits': hits, 'duplicates_total': total, 'window': dedup_window }
+
+def dedup_store(server):
+    if server not in dedup_stores:
+        dedup_stores[server] = DedupStore('%s/notifications_%s.db' % (log_dir, server))
+    return dedup_stores[server]
+
+def dedup_stats():
+    """stats() for each dedup store opened in this process, by server ID."""
+    return dict((server, store.stats()) for (server, store) in dedup_stores.items())
+
+metrics.CounterFunc('lb3_dedup_duplicates_total', 'Duplicate notifications dropped, by server',
+                    lambda: [({ 'server': server }, stats['duplicates_total']) for (server, stats) in dedup_stats().items()])
+
+def is_id_duplicate(server, new_id):
+    try:
+        with metrics.stage_seconds.time(stage = 'dedup'):
+            duplicate = dedup_store(server).is_duplicate(new_id, dedup_window)
+        if duplicate:
+            logger.info("Duplicate ID")
+            metrics.events.inc(event = 'duplicate_notification')
+            return True
+    except:
+        logger.exception("Duplicate detection baddness")
+    return False
+
+def parse_challenge(args):
+    """Handle a subscription challenge GET. Returns the response body and the
+    (un)subscribe message for the bot, or None if the topic doesn't match."""
+    message = None
+    user_id = args['lb3.user_id'][0]
+    logger.info("Response: %s", args['hub.challenge'])
+    logger.info("Mode: %s Topic: %s", args['hub.mode'], args['hub.topic'])
+    response = args['hub.challenge'][0]
+    topic = parse_qsl(args['hub.topic'][0])
+    for user in topic:
+        if user[0].endswith('user_id'):
+            if user_id == user[1]:
+                message = { 'action':  args['hub.mode'][0],
+                            'args': args }
+            else:
+                logger.error("User ID mismatch: url=%s twitch='%s'", user_id, user[1])
+    return (response, message)
+
+def signature_matches(secret, body, sig_input):
+    logger.info('Signature: %s', sig_input)
+    sig_calc = 'sha256=%s' % hmac.new(secret.encode('utf-8'), msg=body.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(sig_input or '', sig_calc):
+        logger.debug(body)
+        logger.error('Signature mismatch')
+        logger.error('Input: %s', sig_input)
+        logger.error('Input: %s', sig_calc)
+        return False
+    return True
+
+def parse_notification(server, args, input_obj, notification_id):
+    """Turn a verified stream notification into a message for the bot, or
+    None if it has no ID or has been seen before."""
+    if notification_id:
+        logger.info('Notification: %s', notification_id)
+        if not is_id_duplicate(server, notification_id):
+            return { 'action':   'stream',
+                     'args':     args,
+                     'data':     input_obj['data'],
+                     'id':       notification_id,
+                     'received': time.time() }
+    else:
+        logger.info('No notification ID')
+    return None